@@ -0,0 +1,52 @@
+from timeit import timeit
+from scanner import Scanner, TokenScanner, TOKEN_ID, tokenize
+from differentiator import differentiate
+from exporttree import python_function
+import numpy as np
+
+# Benchmarks for comparing the faster parts of the tool with the ones they replaced.
+# Run this file directly, every benchmark prints its timings.
+
+def generated_input(terms): # A long machine-generated input, like the ones we get from other tools
+    expression = ' + '.join(f'sin(A *(ij,j->i) x{i % 10}) *(i,->i) {i}.5e-1' for i in range(terms))
+    declaration = ' '.join(f'x{i} 1' for i in range(10))
+    return f'declare A 2 {declaration} expression {expression} derivative wrt x0'
+
+def scan(scanner):
+    tokens = 0
+    while scanner.get_sym()[0] != TOKEN_ID.NONE:
+        tokens += 1
+    return tokens
+
+def benchmark_scanner(terms=20000, repeat=3):
+    input = generated_input(terms)
+    print(f'Scanner benchmark: {len(input)} characters, {scan(TokenScanner(input))} tokens')
+    for scanner_class in [Scanner, TokenScanner]:
+        seconds = timeit(lambda: scan(scanner_class(input)), number=repeat) / repeat
+        print(f'{scanner_class.__name__}: {seconds:.3f}s')
+    seconds = timeit(lambda: tokenize(input), number=repeat) / repeat
+    print(f'tokenize alone: {seconds:.3f}s')
+
+def benchmark_contractions(axis_lengths=[3, 30, 300], repeat=20):
+    diffDag, originalDag, arg_name, variable_ranks = differentiate('declare x 1 A 2 expression A *(ij,j->i) tanh(A *(ij,j->i) x) derivative wrt x')
+    for axis_length in axis_lengths:
+        x, A = np.random.random_sample((axis_length,)), np.random.random_sample((axis_length, axis_length))
+        for optimize in [False, True]:
+            f = python_function(diffDag, ['x', 'A'], optimize=optimize)
+            seconds = timeit(lambda: f(x, A), number=repeat) / repeat
+            print(f'Axis length {axis_length}, optimize={optimize}: {seconds * 1000:.3f}ms')
+
+def benchmark_batched(batch_size=10000):
+    diffDag, originalDag, arg_name, variable_ranks = differentiate('declare x 1 A 2 expression A *(ij,j->i) tanh(A *(ij,j->i) x) derivative wrt x')
+    xs, A = np.random.random_sample((batch_size, 3)), np.random.random_sample((3, 3))
+    f = python_function(diffDag, ['x', 'A'])
+    seconds = timeit(lambda: [f(x, A) for x in xs], number=1)
+    print(f'Batch of {batch_size} in a loop: {seconds:.3f}s')
+    f = python_function(diffDag, ['x', 'A'], batched=['x'])
+    seconds = timeit(lambda: f(xs, A), number=1)
+    print(f'Batch of {batch_size} in one call: {seconds:.3f}s')
+
+if __name__ == '__main__':
+    benchmark_scanner()
+    benchmark_contractions()
+    benchmark_batched()
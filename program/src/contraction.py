@@ -0,0 +1,199 @@
+import numpy as np
+from functools import partial
+from string import ascii_letters
+
+from tree import NODETYPE
+
+# This module plans how the products of a DAG get contracted with numpy, once per product node and shapes of the operands
+
+BLAS_THRESHOLD = 4096   # Contractions with fewer multiplications than this are faster in einsum's own loop than with the transposes for matmul
+OPTIMAL_OPERANDS = 4    # Orders of contractions with up to this many operands get searched exhaustively, larger ones greedily
+MAX_OPERANDS = 32       # Older versions of numpy's einsum take at most this many operands, longer chains of products get split
+
+class ContractionPlans(): # Cache of contraction plans for the products of one compiled function, keyed by product and operand shapes
+    def __init__(self):
+        self.plans = {}
+
+    def contract(self, product, subscripts, *operands):
+        key = (product,) + tuple(np.shape(operand) for operand in operands)
+        plan = self.plans.get(key)
+        if plan == None:
+            plan = plan_contraction(subscripts, *[np.shape(operand) for operand in operands])
+            self.plans[key] = plan
+        return plan(*operands)
+
+    def prepare(self, product, subscripts, *shapes): # Plans a contraction for operands with the given shapes before they get contracted
+        self.plans[(product,) + shapes] = plan_contraction(subscripts, *shapes)
+
+    def __len__(self):
+        return len(self.plans)
+
+
+def plan_contraction(subscripts, *shapes): # Returns a function that computes np.einsum(subscripts, *operands) for operands of the given shapes
+    inputs, result = subscripts.split('->')
+    inputs = inputs.split(',')
+    if len(set(result)) < len(result): # Repeated result indices put the result on a diagonal, like the contractions with lowered deltas
+        return _diagonal_plan(inputs, result, shapes)
+    elif len(inputs) == 2:
+        return _binary_plan(inputs[0], inputs[1], result, shapes[0], shapes[1])
+    elif len(inputs) < 2:
+        return partial(np.einsum, subscripts)
+    # einsum_path picks the order of the pairwise contractions by their number of operations, without intermediate results larger than the largest operand or result
+    path = np.einsum_path(subscripts, *[np.broadcast_to(0.0, shape) for shape in shapes], optimize='optimal' if len(inputs) <= OPTIMAL_OPERANDS else 'greedy')[0][1:]
+    operands = list(zip(inputs, shapes))
+    steps = []
+    for contraction in path:
+        contraction = sorted(contraction, reverse=True)
+        picked = [operands.pop(i) for i in contraction]
+        if operands:
+            remaining = ''.join(indices for indices, _ in operands) + result
+            stepResult = ''.join(i for i in dict.fromkeys(''.join(indices for indices, _ in picked)) if i in remaining)
+        else:
+            stepResult = result
+        sizes = {i: size for indices, shape in picked for i, size in zip(indices, shape)}
+        operands.append((stepResult, tuple(sizes[i] for i in stepResult)))
+        if len(picked) == 2:
+            step = _binary_plan(picked[0][0], picked[1][0], stepResult, picked[0][1], picked[1][1])
+        else: # einsum_path can contract more than two operands at once when that isn't more expensive
+            step = partial(np.einsum, f'{",".join(indices for indices, _ in picked)}->{stepResult}')
+        steps.append((contraction, step))
+
+    def plan(*operands):
+        operands = list(operands)
+        for contraction, step in steps:
+            picked = [operands.pop(i) for i in contraction]
+            operands.append(step(*picked))
+        return operands[0]
+    return plan
+
+
+def _diagonal_plan(inputs, result, shapes):
+    reduced = ''.join(dict.fromkeys(result))
+    plan = plan_contraction(f'{",".join(inputs)}->{reduced}', *shapes)
+    sizes = {i: size for indices, shape in zip(inputs, shapes) for i, size in zip(indices, shape)}
+    shape = tuple(sizes[i] for i in result)
+
+    def diagonal_plan(*operands):
+        out = np.zeros(shape, dtype=np.result_type(*operands))
+        np.einsum(f'{result}->{reduced}', out)[...] = plan(*operands) # einsum returns a writeable view of the diagonal
+        return out
+    return diagonal_plan
+
+
+# Finds chains of products that can be evaluated as one contraction. Products that are only used by another product get fused into it.
+# Returns a dict from the outermost product of each chain to its einsum string and operand nodes.
+# Deltas in the chains get lowered, an operand that is a delta of rank 2k stands for a tensor of ones with its first k axes.
+# Constants whose indices occur in other operands become scalars, ones among them get left out
+def fuse_products(dag):
+    nodes = list(dag.postorder())
+    uses = {}
+    for node in nodes:
+        for child in [node.left, node.right]:
+            if child:
+                uses[child] = uses.get(child, 0) + 1
+    fused = {}
+    inside = set()  # Products that got fused into another product
+    for node in reversed(nodes): # Parents before their children
+        if node.type != NODETYPE.PRODUCT or node in inside:
+            continue
+        letters = [letter for letter in ascii_letters if not letter in node.resultIndices]
+        inputs, operands = [], []
+        _fuse(node, node.resultIndices, uses, letters, inputs, operands, inside)
+        result = _lower_deltas(inputs, operands, node.resultIndices)
+        _lower_constants(inputs, operands)
+        fused[node] = (f'{",".join(inputs)}->{result}', operands)
+    return fused
+
+
+def _fuse(node, indices, uses, letters, inputs, operands, inside): # indices are the names of the result indices of node in the fused contraction
+    stack = _renamed_operands(node, indices, letters)   # Operands still to be added, the next one on top, so that they stay in order from left to right
+    while stack:
+        child, childIndices = stack.pop()
+        if child.type == NODETYPE.PRODUCT and uses[child] == 1 and len(letters) >= len(child.leftIndices + child.rightIndices) and \
+                len(inputs) + len(stack) + 2 <= MAX_OPERANDS:
+            inside.add(child)
+            stack.extend(_renamed_operands(child, childIndices, letters))
+        else:
+            inputs.append(childIndices)
+            operands.append(child)
+
+
+def _renamed_operands(node, indices, letters): # Right and left operand of a product with their indices in the fused contraction
+    renamed = dict(zip(node.resultIndices, indices))
+    for i in node.leftIndices + node.rightIndices:
+        if not i in renamed:
+            renamed[i] = letters.pop(0)
+    return [(child, ''.join(renamed[i] for i in childIndices)) for child, childIndices in [(node.right, node.rightIndices), (node.left, node.leftIndices)]]
+
+
+def _binary_plan(left, right, result, leftShape, rightShape):
+    if len(set(left)) < len(left) or len(set(right)) < len(right): # Repeated indices in one operand (traces, diagonals) can't be lowered to matmul
+        return partial(np.einsum, f'{left},{right}->{result}')
+    sizes = dict(zip(left, leftShape))
+    sizes.update(zip(right, rightShape))
+    batch = [i for i in left if i in right and i in result]
+    contracted = [i for i in left if i in right and not i in result]
+    leftFree = [i for i in left if not i in right and i in result]
+    rightFree = [i for i in right if not i in left and i in result]
+    batchSize, contractedSize, leftSize, rightSize = [_size(indices, sizes) for indices in [batch, contracted, leftFree, rightFree]]
+    if not contracted or batchSize * contractedSize * leftSize * rightSize < BLAS_THRESHOLD:
+        return partial(np.einsum, f'{left},{right}->{result}')
+
+    leftSummed = tuple(left.index(i) for i in left if not i in right and not i in result) # Indices only in one operand get summed out first
+    rightSummed = tuple(right.index(i) for i in right if not i in left and not i in result)
+    leftKept = [i for i in left if i in right or i in result]
+    rightKept = [i for i in right if i in left or i in result]
+    leftPermutation = [leftKept.index(i) for i in batch + leftFree + contracted]
+    rightPermutation = [rightKept.index(i) for i in batch + contracted + rightFree]
+    productIndices = batch + leftFree + rightFree
+    productShape = tuple(sizes[i] for i in productIndices)
+    resultPermutation = [productIndices.index(i) for i in result]
+
+    def plan(a, b):
+        if leftSummed:
+            a = np.sum(a, axis=leftSummed)
+        if rightSummed:
+            b = np.sum(b, axis=rightSummed)
+        a = np.transpose(a, leftPermutation).reshape(batchSize, leftSize, contractedSize)
+        b = np.transpose(b, rightPermutation).reshape(batchSize, contractedSize, rightSize)
+        return np.transpose(np.matmul(a, b).reshape(productShape), resultPermutation)
+    return plan
+
+
+def _size(indices, sizes):
+    size = 1
+    for i in indices:
+        size *= sizes[i]
+    return size
+
+
+# A delta only says that its paired indices are equal, so the second index of every pair gets renamed to the first one in the whole
+# contraction. What is left of the delta is a tensor of ones over the first half of its indices, it's only needed when these indices
+# occur nowhere else, for the sizes of the result or for sums over the diagonal. Returns the new result indices, inputs and operands get changed
+def _lower_deltas(inputs, operands, result):
+    for position, operand in enumerate(operands):
+        if operand.type != NODETYPE.DELTA:
+            continue
+        half = len(inputs[position]) // 2
+        for pair in range(half):
+            first, second = inputs[position][pair], inputs[position][half + pair]
+            inputs[:] = [indices.replace(second, first) for indices in inputs]
+            result = result.replace(second, first)
+        inputs[position] = inputs[position][:half]
+    for position in reversed(range(len(operands))):
+        others = inputs[:position] + inputs[position + 1:]
+        if operands[position].type == NODETYPE.DELTA and others and all(any(i in indices for indices in others) for i in inputs[position]):
+            del inputs[position], operands[position]
+    return result
+
+
+# A constant tensor only adds its axes to the contraction, so it's enough as a scalar when its indices occur in other operands.
+# Without the constant 1 a product becomes a plain reduction or broadcast
+def _lower_constants(inputs, operands):
+    for position in reversed(range(len(operands))):
+        others = inputs[:position] + inputs[position + 1:]
+        if operands[position].type == NODETYPE.CONSTANT and all(any(i in indices for indices in others) for i in inputs[position]):
+            if float(operands[position].name.split('_')[0]) == 1 and others:
+                del inputs[position], operands[position]
+            else:
+                inputs[position] = ''
@@ -0,0 +1,144 @@
+import unittest
+import numpy as np
+from contraction import ContractionPlans, plan_contraction, fuse_products, _binary_plan
+from differentiator import differentiate
+from exporttree import python_function, python_function_code
+from unittest.mock import patch
+
+class ContractionTests(unittest.TestCase):
+    def assert_plan(self, subscripts, *shapes):
+        operands = [np.random.random_sample(shape) for shape in shapes]
+        self.assertTrue(np.allclose(plan_contraction(subscripts, *shapes)(*operands), np.einsum(subscripts, *operands)))
+
+    def test_plans(self):
+        self.assert_plan('ij,jk->ik', (40,30), (30,50))             # Matrix product
+        self.assert_plan('ij,j->i', (80,70), (70,))
+        self.assert_plan('i,i->', (5000,), (5000,))
+        self.assert_plan('bij,bjk->bik', (4,20,30), (4,30,10))      # Batch index in both operands and the result
+        self.assert_plan('ijk,kj->i', (20,30,40), (40,30))          # Several contracted indices in different orders
+        self.assert_plan('ij,jk->ki', (40,30), (30,50))             # Transposed result
+        self.assert_plan('ijl,jk->ik', (40,30,2), (30,50))          # Index only in one operand gets summed
+        self.assert_plan('ij,kl->ijkl', (3,4), (5,6))               # Outer product, nothing to contract
+        self.assert_plan('ii,i->i', (50,50), (50,))                 # Repeated index
+        self.assert_plan(',ij->ij', (), (3,3))
+        self.assert_plan('ij,jk,k->i', (200,200), (200,200), (200,))  # Contracting with the vector first avoids the matrix product
+        self.assert_plan('ab,bc,cd,de,ef->af', (10,40), (40,5), (5,60), (60,2), (2,30))
+        self.assert_plan(',i,i->', (), (4,), (4,))
+
+    def test_diagonal_plans(self): # Repeated result indices put the result on a diagonal
+        a, b = np.random.random_sample((3,4)), np.random.random_sample((4,5))
+        self.assertTrue(np.allclose(plan_contraction('ab->abab', (3,4))(a), np.einsum('ac,bd->abcd', np.eye(3), np.eye(4)) * a[:,:,None,None]))
+        self.assertTrue(np.allclose(plan_contraction('ij,jk->iki', (3,4), (4,5))(a, b), np.einsum('il,ik->ikl', np.eye(3), a @ b)))
+
+    def test_plans_cached(self):
+        plans = ContractionPlans()
+        a, b = np.random.random_sample((40,30)), np.random.random_sample((30,50))
+        for _ in range(3):
+            self.assertTrue(np.allclose(plans.contract(0, 'ij,jk->ik', a, b), a @ b))
+        self.assertEqual(len(plans), 1)
+        plans.contract(0, 'ij,jk->ik', b.T, a.T)    # Other shapes need their own plan
+        plans.contract(1, 'ij,jk->ik', a, b)
+        self.assertEqual(len(plans), 3)
+
+    def test_compiled_function(self):
+        diffDag, originalDag, arg_name, variable_ranks = differentiate('declare x 1 A 2 expression A *(ij,j->i) tanh(A *(ij,j->i) x) derivative wrt x')
+        x, A = np.random.random_sample((100,)), np.random.random_sample((100,100))
+        f = python_function(diffDag, ['x', 'A'])
+        unoptimized = python_function(diffDag, ['x', 'A'], optimize=False)
+        self.assertTrue(np.allclose(f(x, A), unoptimized(x, A)))
+        plans = len(f.contraction_plans)
+        f(x, A)
+        self.assertEqual(len(f.contraction_plans), plans)  # Evaluating again does no planning
+
+    def test_fuse_products(self):
+        diffDag, originalDag, arg_name, variable_ranks = differentiate('declare x 1 A 2 B 2 expression A *(ij,jk->ik) B *(ik,k->i) x derivative wrt x')
+        fused = fuse_products(originalDag)
+        self.assertEqual(list(fused), [originalDag])
+        einsum_string, operands = fused[originalDag]
+        self.assertEqual([operand.name for operand in operands], ['A', 'B', 'x'])
+        A, B, x = np.random.random_sample((3,4)), np.random.random_sample((4,5)), np.random.random_sample((5,))
+        self.assertTrue(np.allclose(np.einsum(einsum_string, A, B, x), A @ B @ x))
+
+    def test_shared_products_not_fused(self):
+        diffDag, originalDag, arg_name, variable_ranks = differentiate('declare x 1 A 2 expression (A *(ij,j->i) x) *(i,i->) (A *(ij,j->i) x) derivative wrt x')
+        fused = fuse_products(originalDag)
+        self.assertEqual(len(fused), 2) # A*x is used twice and gets computed once
+        self.assertEqual(fused[originalDag][1], [originalDag.left, originalDag.left])
+        f = python_function(diffDag, ['x', 'A'])
+        x, A = np.random.random_sample((4,)), np.random.random_sample((4,4))
+        self.assertTrue(np.allclose(f(x, A), 2 * A.T @ A @ x))
+
+    def test_fused_chain_order(self):
+        diffDag, originalDag, arg_name, variable_ranks = differentiate('declare x 1 A 2 B 2 expression A *(ij,jk->ik) B *(ik,k->i) x derivative wrt x')
+        f = python_function(originalDag, ['x', 'A', 'B'])
+        self.assertEqual(python_function_code(originalDag, ['x', 'A', 'B']).count('_contract('), 1)
+        (subscripts, operands), = fuse_products(originalDag).values()
+        self.assertEqual(operands, [originalDag.find('A'), originalDag.find('B'), originalDag.find('x')])
+        steps = []  # Operand and result shapes of the pairwise contractions
+        def binary_plan(left, right, result, leftShape, rightShape):
+            sizes = {**dict(zip(left, leftShape)), **dict(zip(right, rightShape))}
+            steps.append((sorted([leftShape, rightShape]), tuple(sizes[i] for i in result)))
+            return _binary_plan(left, right, result, leftShape, rightShape)
+        with patch('contraction._binary_plan', binary_plan):
+            plan = plan_contraction(subscripts, (300,300), (300,300), (300,))
+        self.assertEqual(steps, [([(300,), (300,300)], (300,))] * 2)  # B times x first, then A times that, never A times B
+        x, A, B = np.random.random_sample((300,)), np.random.random_sample((300,300)), np.random.random_sample((300,300))
+        self.assertTrue(np.allclose(plan(A, B, x), A @ (B @ x)))
+        self.assertTrue(np.allclose(f(x, A, B), A @ (B @ x)))
+
+    def test_lowered_deltas(self):
+        tests = ['declare x 1 expression exp(x) derivative wrt x',
+                 'declare X 2 expression sin(X) derivative wrt X',
+                 'declare X 2 expression adj(X) derivative wrt X',
+                 'declare x 1 A 2 expression A *(ij,j->i) tanh(A *(ij,j->i) x) derivative wrt x',
+                 'declare x 1 A 2 expression (A *(ij,j->i) x) *(i,->i) 2 derivative wrt A',
+                 'declare x 1 expression x *(i,->) 1 derivative wrt x']
+        for test in tests:
+            diffDag, originalDag, arg_name, variable_ranks = differentiate(test)
+            names = list(variable_ranks.keys())
+            self.assertNotIn('np.eye', python_function_code(diffDag, names))
+            values = [np.random.random_sample((3,) * variable_ranks[name]) for name in names]
+            self.assertTrue(np.allclose(python_function(diffDag, names)(*values), python_function(diffDag, names, optimize=False)(*values)))
+
+    def test_delta_sizes(self): # Deltas whose indices occur nowhere else in the contraction still give the sizes of the result
+        tests = ['declare x 1 expression x *(i,->i) 2 derivative wrt x',
+                 'declare x 1 y 0 expression x *(i,->i) y derivative wrt x',
+                 'declare x 1 A 2 expression A *(ij,->ij) (x *(i,i->) x) derivative wrt A']
+        for test in tests:
+            diffDag, originalDag, arg_name, variable_ranks = differentiate(test)
+            names = list(variable_ranks.keys())
+            code = python_function_code(diffDag, names)
+            self.assertNotIn('np.eye', code)
+            self.assertIn('np.broadcast_to(1.0', code)
+            values = [np.random.random_sample((3,) * variable_ranks[name]) for name in names]
+            self.assertTrue(np.allclose(python_function(diffDag, names)(*values), python_function(diffDag, names, optimize=False)(*values)))
+
+    def test_lowered_constants(self):
+        diffDag, originalDag, arg_name, variable_ranks = differentiate('declare x 1 A 2 expression (A *(ij,->ij) 1) *(ij,j->) (x *(i,->i) 3) derivative wrt x')
+        einsum_string, operands = fuse_products(originalDag)[originalDag]
+        self.assertEqual(einsum_string, 'ab,b,->')  # The ones are left out, the 3 becomes a scalar
+        self.assertEqual([operand.name.split('_')[0] for operand in operands], ['A', 'x', '3'])
+        diffDag, originalDag, arg_name, variable_ranks = differentiate('declare X 2 expression X *(ij,->) 1 derivative wrt X')
+        self.assertEqual(fuse_products(originalDag)[originalDag][0], 'ab->')    # A plain sum
+        for test in ['declare x 1 A 2 expression A *(ij,j->i) tanh(A *(ij,j->i) x) derivative wrt x', 'declare X 2 expression X *(ij,->) 1 derivative wrt X',
+                     'declare x 1 A 2 expression (A *(ij,->ij) 1) *(ij,j->) (x *(i,->i) 3) derivative wrt A']:
+            diffDag, originalDag, arg_name, variable_ranks = differentiate(test)
+            names = list(variable_ranks.keys())
+            self.assertNotIn('np.full', python_function_code(diffDag, names) + python_function_code(originalDag, names))
+            values = [np.random.random_sample((3,) * variable_ranks[name]) for name in names]
+            for dag in [originalDag, diffDag]:
+                self.assertTrue(np.allclose(python_function(dag, names)(*values), python_function(dag, names, optimize=False)(*values)))
+
+    def test_prepared_plans(self):
+        diffDag, originalDag, arg_name, variable_ranks = differentiate('declare x 1 A 2 B 2 expression A *(ij,jk->ik) B *(ik,k->i) x derivative wrt x')
+        f = python_function(originalDag, ['x', 'A', 'B'], shapes={'A': (20,30), 'B': (30,40)})
+        self.assertEqual(len(f.contraction_plans), 1)   # Planned when compiling
+        x, A, B = np.random.random_sample((40,)), np.random.random_sample((20,30)), np.random.random_sample((30,40))
+        self.assertTrue(np.allclose(f(x, A, B), A @ B @ x))
+        self.assertEqual(len(f.contraction_plans), 1)
+        g = python_function(originalDag, ['x', 'A', 'B'], varying=['x'], shapes={'A': (20,30), 'B': (30,40), 'x': (40,)})
+        self.assertEqual(len(g.contraction_plans), 2)   # A*B once, then the product with x
+        self.assertTrue(np.allclose(g(x, A, B)(x), A @ B @ x))
+
+if __name__ == '__main__':
+    unittest.main()
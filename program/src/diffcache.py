@@ -0,0 +1,97 @@
+from differentiator import differentiate
+from scanner import tokenize
+from collections import OrderedDict
+from threading import Lock, get_ident
+import hashlib
+import os
+import pickle
+
+# This module contains a cache in front of differentiate, for workloads that differentiate the same expressions over and over
+
+CACHE_VERSION = 1   # Part of every key, needs to be increased when the results of differentiate change, so old files on disk get ignored
+
+def canonical_input(input): # Inputs that only differ in whitespace or the case of keywords and function names get the same canonical form
+    tokens, error = tokenize(input)
+    if error != None:
+        return None
+    return ' '.join(ident for _, ident in tokens if ident != None)
+
+class DiffCache(): # LRU cache of differentiate results in memory, optionally backed by a directory that keeps them between processes
+    def __init__(self, max_entries=256, directory=None, recursive=False):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.recursive = recursive
+        self.entries = OrderedDict()    # Key -> pickled result, the least recently used entry comes first
+        self.lock = Lock()
+        self.hits = 0           # Results found in memory
+        self.disk_hits = 0      # Results found on disk, but not in memory
+        self.misses = 0         # Results that had to be computed
+        self.evictions = 0      # Entries removed from memory because the cache was full
+        if directory != None:
+            os.makedirs(directory, exist_ok=True)
+
+    # Results get stored pickled, so every call gets its own copy of the DAGs and callers can't change the cached ones.
+    # Unpickling is still much cheaper than scanning, parsing and differentiating again
+    def differentiate(self, input):
+        canonical = canonical_input(input)
+        if canonical == None: # Let differentiate raise the error
+            return differentiate(input, self.recursive)
+        key = hashlib.sha256(f'{CACHE_VERSION} {self.recursive} {canonical}'.encode()).hexdigest()
+        with self.lock:
+            data = self.entries.get(key)
+            if data != None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return pickle.loads(data)
+        data = self._load(key)
+        if data != None:
+            with self.lock:
+                self.disk_hits += 1
+            self._remember(key, data)
+            return pickle.loads(data)
+        result = differentiate(input, self.recursive)
+        with self.lock:
+            self.misses += 1
+        try:
+            data = pickle.dumps(result)
+        except RecursionError: # Too deep for pickle, such results just don't get cached
+            return result
+        self._remember(key, data)
+        self._store(key, data)
+        return result
+
+    def statistics(self):
+        with self.lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self.entries)}
+
+    def clear(self): # Only clears the memory, files on disk are kept
+        with self.lock:
+            self.entries.clear()
+
+    def _remember(self, key, data):
+        with self.lock:
+            self.entries[key] = data
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.pickle')
+
+    def _load(self, key):
+        if self.directory == None:
+            return None
+        try:
+            with open(self._path(key), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def _store(self, key, data):
+        if self.directory == None:
+            return
+        temporary = f'{self._path(key)}.{os.getpid()}.{get_ident()}.tmp'
+        with open(temporary, 'wb') as file:
+            file.write(data)
+        os.replace(temporary, self._path(key))  # Other processes never see a half written file
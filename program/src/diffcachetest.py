@@ -0,0 +1,54 @@
+import unittest
+import tempfile
+from diffcache import DiffCache, canonical_input
+from differentiator import differentiate
+from numcheck import numcheck
+
+class DiffCacheTests(unittest.TestCase):
+    def test_canonical_input(self):
+        self.assertEqual(canonical_input('DECLARE a 0\n  expression SIN(a)   derivative WRT a'),
+                         canonical_input('declare a 0 expression sin(a) derivative wrt a'))
+        self.assertNotEqual(canonical_input('declare a 0 expression a derivative wrt a'),
+                            canonical_input('declare A 0 expression A derivative wrt A'))
+        self.assertEqual(canonical_input('declare a 0 expression a $ derivative wrt a'), None)
+
+    def test_hits_and_misses(self):
+        cache = DiffCache()
+        test = 'declare x 1 A 2 expression A *(ij,j->i) tanh(A *(ij,j->i) x) derivative wrt x'
+        d, originalDag, arg_name, variable_ranks = cache.differentiate(test)
+        d_cached, _, _, _ = cache.differentiate('DECLARE x 1 A 2\n  Expression A*(ij,j->i)TANH(A*(ij,j->i)x)\n  Derivative Wrt x')
+        self.assertEqual(str(d), str(differentiate(test)[0]))
+        self.assertEqual(str(d_cached), str(d))
+        self.assertIsNot(d_cached, d)   # Every call gets its own copy
+        self.assertEqual(cache.statistics(), {'hits': 1, 'disk_hits': 0, 'misses': 1, 'evictions': 0, 'entries': 1})
+        d_cached, originalDag, arg_name, variable_ranks = cache.differentiate(test)
+        self.assertTrue(numcheck(originalDag, d_cached, variable_ranks, arg_name))
+
+    def test_eviction(self):
+        cache = DiffCache(max_entries=2)
+        tests = [f'declare a 0 expression a ^ {i} derivative wrt a' for i in range(2, 5)]
+        for test in tests:
+            cache.differentiate(test)
+        cache.differentiate(tests[2])
+        cache.differentiate(tests[0])
+        self.assertEqual(cache.statistics(), {'hits': 1, 'disk_hits': 0, 'misses': 4, 'evictions': 2, 'entries': 2})
+
+    def test_disk(self):
+        test = 'declare X 2 expression adj(X) *(ij,ij->) adj(X) derivative wrt X'
+        with tempfile.TemporaryDirectory() as directory:
+            d, _, _, _ = DiffCache(directory=directory).differentiate(test)
+            cache = DiffCache(directory=directory)   # Like a restarted worker
+            d_cached, _, _, _ = cache.differentiate(test)
+            self.assertEqual(str(d_cached), str(d))
+            self.assertEqual(cache.statistics()['disk_hits'], 1)
+            self.assertEqual(cache.statistics()['misses'], 0)
+
+    def test_errors_are_not_cached(self):
+        cache = DiffCache()
+        for i in range(2):
+            with self.assertRaises(Exception):
+                cache.differentiate('declare a 0 expression a + derivative wrt a')
+        self.assertEqual(cache.statistics()['entries'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,8 @@ from scanner import ELEMENTWISE_FUNCTIONS, TOKEN_ID
 from tree import Tree, NODETYPE, TreeCompanion
 from parser import parse
 import string
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 
 # This module contains a method to differentiate an expression DAG with respect to an argument
 
@@ -13,320 +15,624 @@ import string
 # have the same companion object.
 # -----------------------------------------------------------------
 
-_originalNodeToDiffNode = {} # For a node X, we save where dY/dX is, to allow adding more chain rule contributions when we reach that node again later
-_originalNodeToDiffTree = {} # For a node X, we also save the top of the tree which contains dX/dZ (for possibly 2 nodes Z), which also we need to update when adding chain rule contributions
+def differentiate(input, recursive=False, mode='reverse'): # recursive=True runs the recursive versions of all passes, for comparison in benchmarks
+    return Differentiator(recursive, mode).differentiate(input)
 
-def differentiate(input):
-    global _originalNodeToDiffNode
-    _originalNodeToDiffNode = {}   
-    global _originalNodeToDiffTree
-    _originalNodeToDiffTree = {}
+def differentiate_dag(dag, arg_name, variable_ranks, recursive=False): # Differentiates an already built DAG, e.g. a derivative, without printing and parsing it again
+    return Differentiator(recursive).differentiate_dag(dag, arg_name, variable_ranks)
 
-    originalDag, arg_name, variable_ranks = parse(input)
-    originalDag, arg = _preprocess(originalDag, arg_name, variable_ranks)
+def hessian(input, recursive=False):
+    return Differentiator(recursive).hessian(input)
 
-    originalRank = originalDag.rank
-    if arg == None: # Argument is not in expression
-        diffDag = Tree(NODETYPE.CONSTANT, f'0_{originalDag.companion.new_constant()}', companion=originalDag.companion)
-        diffDag.rank = originalRank * 2
-        diffDag.axes = originalDag.axes + originalDag.axes
+def hessian_vector_product(input, vector_name='v', recursive=False):
+    return Differentiator(recursive).hessian_vector_product(input, vector_name)
+
+def vector_jacobian_product(input, cotangent_name='u', recursive=False):
+    return Differentiator(recursive).vector_jacobian_product(input, cotangent_name)
+
+def jacobian_vector_product(input, tangent_name='v', recursive=False):
+    return Differentiator(recursive).jacobian_vector_product(input, tangent_name)
+
+def differentiate_batch(inputs, recursive=False, max_workers=None, processes=True): # Differentiates several inputs in parallel, results are in the order of the inputs
+    return Differentiator(recursive).differentiate_batch(inputs, max_workers, processes)
+
+class Differentiator(): # Holds all state of one differentiation, so that several differentiations can run at the same time
+    def __init__(self, recursive=False, mode='reverse', shapes=None):
+        if mode not in ['reverse', 'forward', 'auto']:
+            raise Exception(f'Unknown differentiation mode {mode}, expected reverse, forward or auto.')
+        self.recursive = recursive  # Run the recursive versions of all passes
+        self.mode = mode            # 'auto' picks the cheaper mode with choose_mode
+        self.shapes = shapes        # Variable name -> shape, only used by choose_mode, undeclared axes get a default length
+        self.originalNodeToDiffNode = {} # For a node X, we save where dY/dX is, after all chain rule contributions to it were added
+
+    def differentiate(self, input):
+        originalDag, arg_name, variable_ranks = parse(input)
+        diffDag, originalDag = self._differentiate_dag(originalDag, arg_name, variable_ranks)
         return diffDag, originalDag, arg_name, variable_ranks
-    diffDag = Tree(NODETYPE.DELTA, f'delta_{originalDag.companion.new_delta()}', companion=originalDag.companion)   # Derivative of the top node y with respect to itself
-    diffDag.rank = originalRank * 2
-    diffDag.axes = originalDag.axes + originalDag.axes
-    diffDag = _reverse_mode_diff(originalDag, diffDag, arg, originalDag.rank)
-    diffDag.set_tensorrank(variable_ranks, arg)
-    diffDag.add_incoming_edges()
-    diffDag.unify_axes()
-    diffDag.rename_equivalent_constants()
-    diffDag = diffDag.remove_unneccessary_deltas()
-    _simplify(diffDag)
-    diffDag.eliminate_common_subtrees()
-    diffDag.add_incoming_edges()
-    diffDag.set_tensorrank(variable_ranks, arg)
-    diffDag.unify_axes()
-    diffDag.remove_nonexistant_axes()
-    return diffDag, originalDag, arg_name, variable_ranks
+
+    # Returns the derivative and the DAG itself, in an equivalent form that preprocessing rewrote. The rewrites go to a copy,
+    # the DAG the caller holds stays as it is. Derivative DAGs can be put in again, they share the companion with the original DAG
+    def differentiate_dag(self, dag, arg_name, variable_ranks):
+        return self._differentiate_dag(dag.copy(), arg_name, variable_ranks)
+
+    def _differentiate_dag(self, dag, arg_name, variable_ranks): # Rewrites dag, only for DAGs nobody else holds, like a freshly parsed one
+        self.originalNodeToDiffNode = {}
+
+        arg_names = arg_name if isinstance(arg_name, list) else [arg_name]   # Several arguments come as a list of names
+        dag, args = _preprocess(dag, arg_names, variable_ranks, self.recursive)
+
+        diffDags = self._derivatives(dag, arg_names, args, variable_ranks)
+        diffDag = diffDags if isinstance(arg_name, list) else diffDags[0]   # One derivative DAG per argument
+        return diffDag, dag
+
+    def hessian(self, input): # Second derivative, its axes are the ones of the expression followed by the axes of the argument twice
+        diffDag, originalDag, arg_name, variable_ranks = self.differentiate(input)
+        if isinstance(arg_name, list):
+            raise Exception('Expected one argument for the Hessian, but found multiple.')
+        hessianDag, diffDag = self.differentiate_dag(diffDag, arg_name, variable_ranks)
+        return hessianDag, diffDag, originalDag, arg_name, variable_ranks
+
+    # Derivative of (gradient *(...,->...) v) for a new variable v with the shape of the argument. This is the Hessian multiplied with v,
+    # but its DAG never contains a node with the axes of the full Hessian. v gets added to the returned variable ranks
+    def hessian_vector_product(self, input, vector_name='v'):
+        diffDag, originalDag, arg_name, variable_ranks = self.differentiate(input)
+        if isinstance(arg_name, list):
+            raise Exception('Expected one argument for the Hessian-vector product, but found multiple.')
+        if vector_name in variable_ranks:
+            raise Exception(f'Variable {vector_name} for the Hessian-vector product is already declared.')
+        variable_ranks = dict(variable_ranks)
+        variable_ranks[vector_name] = variable_ranks[arg_name]
+        companion = originalDag.companion
+        vector = companion.new_node(NODETYPE.VARIABLE, vector_name)
+        s1 = string.ascii_lowercase[0:originalDag.rank]   # Axes of the expression
+        s2 = string.ascii_lowercase[originalDag.rank:originalDag.rank + variable_ranks[arg_name]]   # Axes of the argument
+        directional = companion.new_node(NODETYPE.PRODUCT, f'*({s1+s2},{s2}->{s1})', diffDag, vector)
+        directional.set_indices(s1+s2, s2, s1)
+        hvpDag, directional = self.differentiate_dag(directional, arg_name, variable_ranks)
+        return hvpDag, directional, originalDag, arg_name, variable_ranks
+
+    # u *(...) dy/dX for a new variable u with the shape of the expression, which takes the place of the delta that reverse mode
+    # starts with. The result has the axes of the argument, no node has the axes of the output and the argument together
+    def vector_jacobian_product(self, input, cotangent_name='u'):
+        originalDag, arg_name, variable_ranks, arg = self._prepare_product(input, cotangent_name)
+        variable_ranks[cotangent_name] = originalDag.rank
+        if arg == None: # Zero with the axes of the argument
+            return _zero(originalDag.companion, _argument_axes(originalDag.companion, arg_name, variable_ranks)), originalDag, arg_name, variable_ranks
+        seed = originalDag.companion.new_node(NODETYPE.VARIABLE, cotangent_name)
+        seed.rank = originalDag.rank
+        self._reverse_mode_diff(originalDag, seed, [arg], 0)  # The seed has no axes in addition to the ones of the expression
+        vjpDag = self._postprocess(self.originalNodeToDiffNode[arg], arg, variable_ranks)
+        _remove_nonexistant_axes([vjpDag])
+        return vjpDag, originalDag, arg_name, variable_ranks
+
+    # dy/dX *(...) v for a new variable v with the shape of the argument, computed in forward mode. The result has the axes of the expression
+    def jacobian_vector_product(self, input, tangent_name='v'):
+        originalDag, arg_name, variable_ranks, arg = self._prepare_product(input, tangent_name)
+        variable_ranks[tangent_name] = variable_ranks.get(arg_name, 0)
+        if arg == None: # Zero with the axes of the expression
+            return _zero(originalDag.companion, originalDag.axes), originalDag, arg_name, variable_ranks
+        seed = originalDag.companion.new_node(NODETYPE.VARIABLE, tangent_name)
+        seed.rank = variable_ranks[tangent_name]
+        jvpDag = self._postprocess(_forward_mode_diff(originalDag, arg, seed), arg, variable_ranks)
+        _remove_nonexistant_axes([jvpDag])
+        return jvpDag, originalDag, arg_name, variable_ranks
+
+    def _prepare_product(self, input, seed_name):
+        self.originalNodeToDiffNode = {}
+        originalDag, arg_name, variable_ranks = parse(input)
+        if isinstance(arg_name, list):
+            raise Exception('Expected one argument for the product with the derivative, but found multiple.')
+        if seed_name in variable_ranks:
+            raise Exception(f'Variable {seed_name} for the product with the derivative is already declared.')
+        originalDag, args = _preprocess(originalDag, [arg_name], variable_ranks, self.recursive)
+        return originalDag, arg_name, dict(variable_ranks), args[0]
+
+    # In reverse mode, all derivatives come from one pass, so they share the adjoints of common nodes.
+    # In forward mode, every argument gets its own pass
+    def _derivatives(self, originalDag, arg_names, args, variable_ranks):
+        originalRank = originalDag.rank
+        present_args = [arg for arg in args if arg != None]
+        mode = self.mode
+        if mode == 'auto':
+            mode = choose_mode(originalDag, present_args, self.shapes)
+        if present_args and mode == 'reverse':
+            diffDag = originalDag.companion.new_node(NODETYPE.DELTA, f'delta_{originalDag.companion.new_delta()}')   # Derivative of the top node y with respect to itself
+            diffDag.rank = originalRank * 2
+            diffDag.axes = originalDag.axes + originalDag.axes
+            self._reverse_mode_diff(originalDag, diffDag, present_args, originalDag.rank)
+        diffDags = []
+        for arg_name, arg in zip(arg_names, args):
+            if arg == None: # Argument is not in expression
+                diffDags.append(_zero(originalDag.companion, originalDag.axes + _argument_axes(originalDag.companion, arg_name, variable_ranks)))
+            elif mode == 'forward':
+                diffDags.append(_forward_mode_diff(originalDag, arg))
+            else:
+                diffDags.append(self.originalNodeToDiffNode[arg])   # The adjoint of the argument, after all contributions to it were added
+        for i, arg in enumerate(args):
+            if arg != None: # Derivatives for later arguments can reuse the nodes that got inferred and simplified for earlier ones
+                diffDags[i] = self._postprocess(diffDags[i], arg, variable_ranks)
+        for i, arg in enumerate(args):
+            if arg != None and len(present_args) > 1: # Later derivatives may have rewritten nodes that earlier ones share
+                diffDags[i].add_incoming_edges()
+                diffDags[i].set_tensorrank(variable_ranks, arg, self.recursive)
+                diffDags[i].unify_axes(self.recursive)
+        if present_args:
+            _remove_nonexistant_axes(diffDags)
+        return diffDags
+
+    def _postprocess(self, diffDag, arg, variable_ranks):
+        diffDag.set_tensorrank(variable_ranks, arg, self.recursive)
+        diffDag.add_incoming_edges()
+        diffDag.unify_axes(self.recursive)
+        diffDag.rename_equivalent_constants()
+        diffDag = diffDag.remove_unneccessary_deltas(self.recursive)
+        _simplify(diffDag, self.recursive)
+        diffDag.eliminate_common_subtrees()
+        diffDag.add_incoming_edges()
+        diffDag.set_tensorrank(variable_ranks, arg, self.recursive)
+        diffDag.unify_axes(self.recursive)
+        return diffDag
+
+    def differentiate_batch(self, inputs, max_workers=None, processes=True): # Every input gets its own Differentiator, processes=False uses threads instead
+        executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with executor_class(max_workers=max_workers) as executor:
+            return list(executor.map(partial(differentiate, recursive=self.recursive, mode=self.mode), inputs))
+
+    # Every node is reached after all of its parents, so all chain rule contributions to dY/dX are known by then. They get summed up
+    # in new nodes before the diff rule passes dY/dX on to the operands of X, nodes of the derivative never get rewired afterwards
+    def _reverse_mode_diff(self, node, diff, args, yRank):  # node: top node in original dag | diff : node that contains derivative with respect to node.
+        order = _reverse_topological_recursive(node) if self.recursive else node.reverse_topological()
+        arrival = _arrival_order(node, args)
+        contributions = {node: [(-1, diff)]}  # Node X -> chain rule contributions to dY/dX, with the arrival of the edge they come from
+        for current in order:
+            if not current in contributions:    # Doesn't contain an argument
+                continue
+            diff = None
+            for _, contribution in sorted(contributions.pop(current), key=lambda c: c[0]):
+                diff = contribution if diff == None else diff.companion.new_node(NODETYPE.SUM, '+', diff, contribution)
+            self.originalNodeToDiffNode[current] = diff
+            for i, (operand, operandDiff) in enumerate(_diff_rule(current, diff, args, yRank)):
+                contributions.setdefault(operand, []).append((arrival[(current, i)], operandDiff))
+
+# Numbers the edges to operands that contain an argument, in the order in which a depth first search takes them. The contributions to an adjoint
+# get summed in this order, so that the terms of a derivative don't depend on the order in which the nodes are visited
+def _arrival_order(node, args):
+    arrival = {}    # (Parent, number of the operand among the ones that contain an argument) -> position
+    visited = {node}
+    stack = [(node, 0)]
+    while stack:
+        parent, i = stack.pop()
+        operands = [operand for operand in [parent.left, parent.right] if operand and operand.contains_any(args)]
+        if i < len(operands):
+            stack.append((parent, i + 1))
+            arrival[(parent, i)] = len(arrival)
+            if not operands[i] in visited:
+                visited.add(operands[i])
+                stack.append((operands[i], 0))
+    return arrival
+
+def _reverse_topological_recursive(node, visited=None, order=None): # Like Tree.reverse_topological, but with recursion
+    if visited == None:
+        visited, order = set(), []
+    if not node in visited:
+        visited.add(node)
+        if node.left: _reverse_topological_recursive(node.left, visited, order)
+        if node.right: _reverse_topological_recursive(node.right, visited, order)
+        order.append(node)
+    return reversed(order)
+
+def _zero(companion, axes): # Derivative that is zero everywhere
+    zero = companion.new_node(NODETYPE.CONSTANT, f'0_{companion.new_constant()}')
+    zero.rank = len(axes)
+    zero.axes = axes
+    return zero
+
+def _argument_axes(companion, arg_name, variable_ranks): # New axes for an argument that does not occur in the DAG, undeclared ones have none
+    axes = []
+    for i in range(variable_ranks.get(arg_name, 0)):
+        axis = companion.new_axis()
+        axes.append(axis)
+        companion.axis_to_origin[axis] = f'{arg_name}[{i}]'
+    return axes
 
 def print_axes_help(diffDag):
     print(f'Axis Origins: {diffDag.companion.axis_to_origin}')
     print(f'Variable and Constant Axes:')
-    done_nodes = []
     for node in diffDag.get_all_subtrees():
-        if node and (not node in done_nodes) and (node.type == NODETYPE.VARIABLE or node.type == NODETYPE.CONSTANT or node.type == NODETYPE.DELTA):
-            print(f'{node.name} {node.axes}')
-            done_nodes.append(node)
+        if node.type == NODETYPE.VARIABLE or node.type == NODETYPE.CONSTANT or node.type == NODETYPE.DELTA:
+            print(f'{node.name} {[diffDag.companion.find_axis(axis) for axis in node.axes]}')
     for constant in diffDag.companion.printing_constants.keys():
-        print(f'{constant} {diffDag.companion.printing_constants[constant]}')
+        print(f'{constant} {[diffDag.companion.find_axis(axis) for axis in diffDag.companion.printing_constants[constant]]}')
 
-def _preprocess(originalDag, arg_name, variable_ranks):
+# Forward mode computes dN/dX for every node N that contains the argument X, children before their parents.
+# The axes of N come first, so the result has the same axes as the one from reverse mode
+# A seed variable v with the shape of the argument takes the place of dX/dX, then the result is the Jacobian-vector product
+def _forward_mode_diff(dag, arg, seed=None):
+    tangentRank = 0   # Number of axes that tangents have in addition to the ones of their node
+    if seed == None:
+        seed = dag.companion.new_node(NODETYPE.DELTA, f'delta_{dag.companion.new_delta()}')
+        seed.rank = arg.rank * 2
+        seed.axes = arg.axes + arg.axes
+        tangentRank = arg.rank
+    tangents = {}
+    for node in dag.postorder():
+        if node == arg:
+            tangents[node] = seed
+        elif node.contains(arg):
+            tangents[node] = _tangent_rule(node, tangents, tangentRank)
+    return tangents[dag]
+
+def _tangent_rule(node, tangents, tangentRank): # Builds dN/dX from the derivatives of the operands, None stands for operands without the argument
+    companion = node.companion
+    left = tangents.get(node.left)
+    right = tangents.get(node.right)
+    if node.type in [NODETYPE.SUM, NODETYPE.DIFFERENCE]:
+        if right != None and node.type == NODETYPE.DIFFERENCE:
+            right = companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, right)
+        if left == None:
+            return right
+        if right == None:
+            return left
+        return companion.new_node(NODETYPE.SUM, '+', left, right)
+    if node.type == NODETYPE.PRODUCT:
+        s1 = node.leftIndices
+        s2 = node.rightIndices
+        s3 = node.resultIndices
+        t = ''.join([i for i in string.ascii_lowercase if i not in (s1 + s2 + s3)][0:tangentRank])   # Some unused indices for the argument
+        tangent = None
+        if left != None:
+            tangent = companion.new_node(NODETYPE.PRODUCT, f'*({s1+t},{s2}->{s3+t})', left, node.right)   # Product rule
+            tangent.set_indices(s1+t, s2, s3+t)
+        if right != None:
+            rightTangent = companion.new_node(NODETYPE.PRODUCT, f'*({s1},{s2+t}->{s3+t})', node.left, right)
+            rightTangent.set_indices(s1, s2+t, s3+t)
+            tangent = rightTangent if tangent == None else companion.new_node(NODETYPE.SUM, '+', tangent, rightTangent)
+        return tangent
+    if node.type == NODETYPE.POWER:
+        if left != None:    # Same procedure as with an elementwise function
+            funcDiff = _power_base_derivative(node)
+            s1 = string.ascii_lowercase[0:node.left.rank]
+            t = string.ascii_lowercase[node.left.rank:node.left.rank + tangentRank]
+            tangent = companion.new_node(NODETYPE.PRODUCT, f'*({s1},{s1+t}->{s1+t})', funcDiff, left)
+            tangent.set_indices(s1, s1+t, s1+t)
+        else:
+            s2 = string.ascii_lowercase[0:node.rank]
+            t = string.ascii_lowercase[node.rank:node.rank + tangentRank]
+            funcDiff = _power_exponent_derivative(node, s2)
+            tangent = companion.new_node(NODETYPE.PRODUCT, f'*({s2},{t}->{s2+t})', funcDiff, right)
+            tangent.set_indices(s2, t, s2+t)
+        return tangent
+    if node.type == NODETYPE.ELEMENTWISE_FUNCTION:
+        funcDiff = _elementwise_derivative(node)
+        s1 = string.ascii_lowercase[0:node.right.rank]
+        t = string.ascii_lowercase[node.right.rank:node.right.rank + tangentRank]
+        tangent = companion.new_node(NODETYPE.PRODUCT, f'*({s1},{s1+t}->{s1+t})', funcDiff, right)
+        tangent.set_indices(s1, s1+t, s1+t)
+        return tangent
+    if node.type == NODETYPE.SPECIAL_FUNCTION:
+        funcDiff = _special_derivative(node)
+        s1 = string.ascii_lowercase[0:node.right.rank]
+        s2 = string.ascii_lowercase[node.right.rank:node.right.rank + node.rank]
+        t = string.ascii_lowercase[node.right.rank + node.rank:node.right.rank + node.rank + tangentRank]
+        tangent = companion.new_node(NODETYPE.PRODUCT, f'*({s2+s1},{s1+t}->{s2+t})', funcDiff, right)
+        tangent.set_indices(s2+s1, s1+t, s2+t)
+        return tangent
+    raise Exception(f'Unknown node {node.name} encountered during forward mode differentiation.')
+
+# Cost model for the choice between forward and reverse mode: every node N that contains an argument gets a derivative with
+# the entries of N times the entries of the argument (forward mode, one pass per argument) or of the output (reverse mode)
+def choose_mode(dag, args, shapes=None, axis_length=3):
+    forward, reverse = mode_costs(dag, args, shapes, axis_length)
+    return 'forward' if forward < reverse else 'reverse'
+
+def mode_costs(dag, args, shapes=None, axis_length=3): # Number of derivative entries that forward and reverse mode create
+    def size(axes):
+        entries = 1
+        for axis in axes:
+            origin = dag.companion.axis_to_origin.get(dag.companion.find_axis(axis), '')
+            name = origin.split('[')[0]
+            if shapes and name in shapes and '[' in origin:
+                entries *= shapes[name][int(origin.split('[')[1].split(']')[0])]
+            else:
+                entries *= axis_length
+        return entries
+    output_size = size(dag.axes)
+    args_size = sum(size(arg.axes) for arg in args)
+    forward = 0
+    reverse = 0
+    for node in dag.postorder():
+        if node.contains_any(args):
+            forward += size(node.axes) * args_size
+            reverse += size(node.axes) * output_size
+    return forward, reverse
+
+def _preprocess(originalDag, arg_names, variable_ranks, recursive=False):
+    def find_args():
+        return [originalDag.find(arg_name) for arg_name in arg_names]
     originalDag.eliminate_common_subtrees()
-    arg = originalDag.find(arg_name)
-    originalDag = originalDag.fix_missing_indices(arg)
+    args = find_args()
+    originalDag = originalDag.fix_missing_indices(args, recursive)
     originalDag.add_incoming_edges()
-    originalDag.set_tensorrank(variable_ranks, arg)
-    arg = originalDag.find(arg_name)
-    originalDag = _split_double_powers(originalDag, arg)
+    originalDag.set_tensorrank(variable_ranks, args, recursive)
+    args = find_args()
+    originalDag = _split_double_powers(originalDag, args)
     originalDag = _split_adj(originalDag)
     originalDag.add_incoming_edges()
-    originalDag.set_tensorrank(variable_ranks, arg)
-    originalDag.unify_axes()
-    arg = originalDag.find(arg_name) # Call this again since arg-subtree may have changed
-    return originalDag, arg
+    originalDag.set_tensorrank(variable_ranks, args, recursive)
+    originalDag.unify_axes(recursive)
+    args = find_args() # Call this again since arg-subtrees may have changed
+    return originalDag, args
+
+def _remove_nonexistant_axes(diffDags): # Like Tree.remove_nonexistant_axes, but keeps the axes that occur in any of the DAGs
+    companion = diffDags[0].companion
+    occurring_axes = set()
+    for diffDag in diffDags:
+        for node in diffDag.postorder():
+            occurring_axes.update(companion.find_axis(axis) for axis in node.axes)
+    for axis in [axis for axis in companion.axis_to_origin.keys() if axis not in occurring_axes]:
+        companion.axis_to_origin.pop(axis)
 
-def _split_double_powers(dag, arg):
+def _split_double_powers(dag, args):
     def create_split_power(node):
         indices = ''.join([i for i in string.ascii_lowercase][0:node.left.rank])
-        prod = Tree(NODETYPE.PRODUCT, f'*(,{indices}->{indices})', node.right, Tree(NODETYPE.ELEMENTWISE_FUNCTION, 'log', None, node.left, companion=node.companion), companion=node.companion)
+        prod = node.companion.new_node(NODETYPE.PRODUCT, f'*(,{indices}->{indices})', node.right, node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, 'log', None, node.left))
         prod.set_indices('', indices, indices)
-        return Tree(NODETYPE.ELEMENTWISE_FUNCTION, 'exp', None, prod, companion=node.companion)
+        return node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, 'exp', None, prod)
 
-    if dag.type == NODETYPE.POWER and dag.left.contains(arg) and dag.right.contains(arg):
+    if dag.type == NODETYPE.POWER and _in_both(dag.left, dag.right, args):
         dag = create_split_power(dag)
 
-    def split_powers_helper(node):
-        if node.left: split_powers_helper(node.left)
-        if node.right: split_powers_helper(node.right)
-        if node.left and node.left.type == NODETYPE.POWER and node.left.left.contains(arg) and node.left.right.contains(arg):
-            node.left = create_split_power(node.left)
-        if node.right and node.right.type == NODETYPE.POWER and node.right.left.contains(arg) and node.right.right.contains(arg):
-            node.right = create_split_power(node.right)
-    split_powers_helper(dag)
+    for node in list(dag.postorder()):
+        if node.left and node.left.type == NODETYPE.POWER and _in_both(node.left.left, node.left.right, args):
+            node.set_left(create_split_power(node.left))
+        if node.right and node.right.type == NODETYPE.POWER and _in_both(node.right.left, node.right.right, args):
+            node.set_right(create_split_power(node.right))
     return dag
 
+def _in_both(left, right, args): # Whether one of the arguments occurs in both operands, different arguments in the operands are fine
+    return any(left.contains(arg) and right.contains(arg) for arg in args)
+
 def _split_adj(dag):
     if dag.type == NODETYPE.SPECIAL_FUNCTION and dag.name == 'adj':
-        dag = Tree(NODETYPE.PRODUCT, '*(,ij->ij)', Tree(NODETYPE.SPECIAL_FUNCTION, 'det', None, dag.right, companion=dag.companion), Tree(NODETYPE.SPECIAL_FUNCTION, 'inv', None, dag.right, companion=dag.companion), companion=dag.companion)
+        dag = dag.companion.new_node(NODETYPE.PRODUCT, '*(,ij->ij)', dag.companion.new_node(NODETYPE.SPECIAL_FUNCTION, 'det', None, dag.right), dag.companion.new_node(NODETYPE.SPECIAL_FUNCTION, 'inv', None, dag.right))
         dag.set_indices('', 'ij', 'ij')
-    def split_adj_helper(node):
-        if node.left: split_adj_helper(node.left)
-        if node.right: split_adj_helper(node.right)
+    for node in list(dag.postorder()):
         if node.left and node.left.type == NODETYPE.SPECIAL_FUNCTION and node.left.name == 'adj':
-            node.left = Tree(NODETYPE.PRODUCT, '*(,ij->ij)', Tree(NODETYPE.SPECIAL_FUNCTION, 'det', None, node.left.right, companion=node.companion), Tree(NODETYPE.SPECIAL_FUNCTION, 'inv', None, node.left.right, companion=node.companion), companion=node.companion)
+            node.set_left(node.companion.new_node(NODETYPE.PRODUCT, '*(,ij->ij)', node.companion.new_node(NODETYPE.SPECIAL_FUNCTION, 'det', None, node.left.right), node.companion.new_node(NODETYPE.SPECIAL_FUNCTION, 'inv', None, node.left.right)))
             node.left.set_indices('', 'ij', 'ij')
         if node.right and node.right.type == NODETYPE.SPECIAL_FUNCTION and node.right.name == 'adj':
-            node.right = Tree(NODETYPE.PRODUCT, '*(,ij->ij)', Tree(NODETYPE.SPECIAL_FUNCTION, 'det', None, node.right.right, companion=node.companion), Tree(NODETYPE.SPECIAL_FUNCTION, 'inv', None, node.right.right, companion=node.companion), companion=node.companion)
+            node.set_right(node.companion.new_node(NODETYPE.PRODUCT, '*(,ij->ij)', node.companion.new_node(NODETYPE.SPECIAL_FUNCTION, 'det', None, node.right.right), node.companion.new_node(NODETYPE.SPECIAL_FUNCTION, 'inv', None, node.right.right)))
             node.right.set_indices('', 'ij', 'ij')
-    split_adj_helper(dag)
     return dag
 
-def _reverse_mode_diff(node, diff, arg, yRank):  # Computes derivative of node.left and node.right | node: node in original dag | diff : node that contains derivative with respect to node.
+# The diff rules are generators, they yield (operand, diff) for every chain rule contribution to an operand
+def _diff_rule(node, diff, args, yRank):
     if node.type == NODETYPE.PRODUCT:
-        diff = _diff_product(node, diff, arg, yRank)
+        return _diff_product(node, diff, args, yRank)
     elif node.type == NODETYPE.SUM:
-        diff = _diff_sum(node, diff, arg, yRank)
+        return _diff_sum(node, diff, args, yRank)
+    elif node.type == NODETYPE.DIFFERENCE:
+        return _diff_difference(node, diff, args, yRank)
     elif node.type == NODETYPE.POWER:
-        diff = _diff_power(node, diff, arg, yRank)
+        return _diff_power(node, diff, args, yRank)
     elif node.type == NODETYPE.ELEMENTWISE_FUNCTION:
-        diff = _diff_elementwise_function(node, diff, arg, yRank)
+        return _diff_elementwise_function(node, diff, args, yRank)
     elif node.type == NODETYPE.SPECIAL_FUNCTION:
-        diff = _diff_special_function(node, diff, arg, yRank)
+        return _diff_special_function(node, diff, args, yRank)
     elif node.type == NODETYPE.VARIABLE:
-        diff = _diff_variable(node, diff, arg)
-    return diff
+        _diff_variable(node, diff, args)
+    return iter(())
 
-def _diff_product(node, diff, arg, yRank):
+def _diff_product(node, diff, args, yRank):
     currentDiffNode = diff
     s1 = node.leftIndices
     s2 = node.rightIndices
     s3 = node.resultIndices
     s4 = ''.join([i for i in string.ascii_lowercase if i not in (s1 + s2 + s3)][0:yRank])   # Use some unused indices for the output node y
-    if node.left and node.left.contains(arg):
-        diff = Tree(NODETYPE.PRODUCT, f'*({s4+s3},{s2}->{s4+s1})', currentDiffNode, node.right, companion=currentDiffNode.companion)   # Diff rule
+    if node.left and node.left.contains_any(args):
+        diff = currentDiffNode.companion.new_node(NODETYPE.PRODUCT, f'*({s4+s3},{s2}->{s4+s1})', currentDiffNode, node.right)   # Diff rule
         diff.set_indices(s4+s3, s2, s4+s1)
-        diff = _contributions(node.left, diff, arg, yRank)
-    if node.right and node.right.contains(arg):
-        diff = Tree(NODETYPE.PRODUCT, f'*({s4+s3},{s1}->{s4+s2})', currentDiffNode, node.left, companion=currentDiffNode.companion)
+        yield node.left, diff
+    if node.right and node.right.contains_any(args):
+        diff = currentDiffNode.companion.new_node(NODETYPE.PRODUCT, f'*({s4+s3},{s1}->{s4+s2})', currentDiffNode, node.left)
         diff.set_indices(s4+s3, s1, s4+s2)
-        diff = _contributions(node.right, diff, arg, yRank)
-    return diff
+        yield node.right, diff
 
-def _diff_sum(node, diff, arg, yRank):
+def _diff_sum(node, diff, args, yRank):
     currentDiffNode = diff
-    if node.left and node.left.contains(arg):
-        diff = _contributions(node.left, currentDiffNode, arg, yRank)
-    if node.right and node.right.contains(arg):
-        diff = _contributions(node.right, currentDiffNode, arg, yRank)
-    return diff
+    if node.left and node.left.contains_any(args):
+        yield node.left, currentDiffNode
+    if node.right and node.right.contains_any(args):
+        yield node.right, currentDiffNode
 
-def _diff_power(node, diff, arg, yRank):
-    if node.left and node.right and node.left.contains(arg) and node.right.contains(arg):
+def _diff_difference(node, diff, args, yRank):   # Derivatives contain differences, which the parser never creates
+    currentDiffNode = diff
+    if node.left and node.left.contains_any(args):
+        yield node.left, currentDiffNode
+    if node.right and node.right.contains_any(args):
+        yield node.right, currentDiffNode.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, currentDiffNode)
+
+def _diff_power(node, diff, args, yRank):
+    if node.left and node.right and _in_both(node.left, node.right, args):
         raise Exception('Encountered power node with argument in left and right operands during differentiation.')  # This case is handled by a previous transform of the expression
-    if node.left and node.left.contains(arg):
-        indices = ''.join([i for i in string.ascii_lowercase][0:node.left.rank])
-        one = Tree(NODETYPE.CONSTANT, f'1_{diff.companion.new_constant()}', companion=diff.companion)
-        one.rank = 0
-        newpower = Tree(NODETYPE.POWER, '^', node.left, Tree(NODETYPE.SUM, '+', node.right, Tree(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, one, companion=diff.companion), companion=diff.companion), companion=diff.companion)
-        funcDiff = Tree(NODETYPE.PRODUCT, f'*(,{indices}->{indices})', node.right, newpower, companion=diff.companion)
-        funcDiff.set_indices('', indices, indices)
+    currentDiffNode = diff
+    if node.left and node.left.contains_any(args):
+        funcDiff = _power_base_derivative(node)
         s1 = ''.join(string.ascii_lowercase[0:node.left.rank])   # Same procedure as with an elementwise function
         s2 = ''.join([i for i in string.ascii_lowercase if i not in s1][0:yRank])
-        diff = Tree(NODETYPE.PRODUCT, f'*({s2+s1},{s1}->{s2+s1})', diff, funcDiff, companion=diff.companion) # Diff rule
+        diff = diff.companion.new_node(NODETYPE.PRODUCT, f'*({s2+s1},{s1}->{s2+s1})', diff, funcDiff) # Diff rule
         diff.set_indices(s2+s1, s1, s2+s1)
-        diff = _contributions(node.left, diff, arg, yRank)
-    elif node.right and node.right.contains(arg):
+        yield node.left, diff
+    if node.right and node.right.contains_any(args):   # With several arguments, both operands can contain one of them
+        diff = currentDiffNode
         s3 = ''.join([i for i in string.ascii_lowercase][0:yRank])
         s2 = ''.join([i for i in string.ascii_lowercase if not i in s3][0:node.rank])
         s1 = ''
-        funcDiff = Tree(NODETYPE.PRODUCT, f'*({s2},{s2}->{s2})', node, Tree(NODETYPE.ELEMENTWISE_FUNCTION, 'log', None, node.left, companion=diff.companion), companion=diff.companion)
-        funcDiff.set_indices(s2, s2, s2)
-        diff = Tree(NODETYPE.PRODUCT, f'*({s3+s2},{s2+s1}->{s3+s1})', diff, funcDiff, companion=diff.companion)
+        funcDiff = _power_exponent_derivative(node, s2)
+        diff = diff.companion.new_node(NODETYPE.PRODUCT, f'*({s3+s2},{s2+s1}->{s3+s1})', diff, funcDiff)
         diff.set_indices(s3+s2, s2+s1, s3+s1)
-        diff = _contributions(node.right, diff, arg, yRank)
-    return diff
+        yield node.right, diff
+
+def _power_base_derivative(node): # Elementwise derivative of a power with respect to its base, b * a^(b-1)
+    indices = ''.join([i for i in string.ascii_lowercase][0:node.left.rank])
+    one = node.companion.new_node(NODETYPE.CONSTANT, f'1_{node.companion.new_constant()}')
+    one.rank = 0
+    newpower = node.companion.new_node(NODETYPE.POWER, '^', node.left, node.companion.new_node(NODETYPE.SUM, '+', node.right, node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, one)))
+    funcDiff = node.companion.new_node(NODETYPE.PRODUCT, f'*(,{indices}->{indices})', node.right, newpower)
+    funcDiff.set_indices('', indices, indices)
+    return funcDiff
+
+def _power_exponent_derivative(node, indices): # Elementwise derivative of a power with respect to its (scalar) exponent, a^b * log(a)
+    funcDiff = node.companion.new_node(NODETYPE.PRODUCT, f'*({indices},{indices}->{indices})', node, node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, 'log', None, node.left))
+    funcDiff.set_indices(indices, indices, indices)
+    return funcDiff
+
+def _diff_elementwise_function(node, diff, args, yRank):
+    funcDiff = _elementwise_derivative(node)
+    s1 = ''.join(string.ascii_lowercase[0:node.right.rank])
+    s2 = ''.join([i for i in string.ascii_lowercase if i not in s1][0:yRank])
+    diff = diff.companion.new_node(NODETYPE.PRODUCT, f'*({s2+s1},{s1}->{s2+s1})', diff, funcDiff) # Diff rule
+    diff.set_indices(s2+s1, s1, s2+s1)
+    if node.right and node.right.contains_any(args):
+        yield node.right, diff
 
-def _diff_elementwise_function(node, diff, arg, yRank):
+def _elementwise_derivative(node): # Elementwise derivative of the function with respect to its operand, it has the rank of the operand
     if node.name == '-':
-        const = Tree(NODETYPE.CONSTANT, f'1_{diff.companion.new_constant()}', companion=diff.companion)
+        const = node.companion.new_node(NODETYPE.CONSTANT, f'1_{node.companion.new_constant()}')
         const.rank = node.right.rank
         const.axes = node.right.axes
-        funcDiff = Tree(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, const, companion=diff.companion)
+        funcDiff = node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, const)
     elif node.name == 'sin':
-        funcDiff = Tree(NODETYPE.ELEMENTWISE_FUNCTION, 'cos', None, node.right, companion=diff.companion)
+        funcDiff = node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, 'cos', None, node.right)
     elif node.name == 'cos':
-        funcDiff = Tree(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, Tree(NODETYPE.ELEMENTWISE_FUNCTION, 'sin', None, node.right, companion=diff.companion), companion=diff.companion)
+        funcDiff = node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, 'sin', None, node.right))
     elif node.name == 'tan':
-        cos = Tree(NODETYPE.ELEMENTWISE_FUNCTION, 'cos', None, node.right, companion=diff.companion)
+        cos = node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, 'cos', None, node.right)
         indices = ''.join([i for i in string.ascii_lowercase][0:node.right.rank])
-        cos_squared = Tree(NODETYPE.PRODUCT, f'*({indices},{indices}->{indices})', cos, cos, companion=diff.companion)
+        cos_squared = node.companion.new_node(NODETYPE.PRODUCT, f'*({indices},{indices}->{indices})', cos, cos)
         cos_squared.set_indices(indices, indices, indices)
-        funcDiff = Tree(NODETYPE.ELEMENTWISE_FUNCTION, 'elementwise_inverse', None, cos_squared, companion=diff.companion)
+        funcDiff = node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, 'elementwise_inverse', None, cos_squared)
     elif node.name == 'arcsin':
-        const1 = Tree(NODETYPE.CONSTANT, f'2_{diff.companion.new_constant()}', companion=diff.companion)
+        const1 = node.companion.new_node(NODETYPE.CONSTANT, f'2_{node.companion.new_constant()}')
         const1.rank = node.right.rank
         const1.axes = node.right.axes
-        x_squared = Tree(NODETYPE.POWER, '^', node.right, const1)
-        const2 = Tree(NODETYPE.CONSTANT, f'1_{diff.companion.new_constant()}', companion=diff.companion)
+        x_squared = node.companion.new_node(NODETYPE.POWER, '^', node.right, const1)
+        const2 = node.companion.new_node(NODETYPE.CONSTANT, f'1_{node.companion.new_constant()}')
         const2.rank = node.right.rank
         const2.axes = node.right.axes
-        inside_root = Tree(NODETYPE.SUM, '+', const2, Tree(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, x_squared, companion=diff.companion), companion=diff.companion)
-        const3 = Tree(NODETYPE.CONSTANT, f'0.5_{diff.companion.new_constant()}', companion=diff.companion)
+        inside_root = node.companion.new_node(NODETYPE.SUM, '+', const2, node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, x_squared))
+        const3 = node.companion.new_node(NODETYPE.CONSTANT, f'0.5_{node.companion.new_constant()}')
         const3.rank = 0
         const3.axes = []
-        funcDiff = Tree(NODETYPE.ELEMENTWISE_FUNCTION, 'elementwise_inverse', None, Tree(NODETYPE.POWER, '^', inside_root, const3, companion=diff.companion), companion=diff.companion)
+        funcDiff = node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, 'elementwise_inverse', None, node.companion.new_node(NODETYPE.POWER, '^', inside_root, const3))
     elif node.name == 'arccos':
-        const1 = Tree(NODETYPE.CONSTANT, f'2_{diff.companion.new_constant()}', companion=diff.companion)
+        const1 = node.companion.new_node(NODETYPE.CONSTANT, f'2_{node.companion.new_constant()}')
         const1.rank = node.right.rank
         const1.axes = node.right.axes
-        x_squared = Tree(NODETYPE.POWER, '^', node.right, const1, companion=diff.companion)
-        const2 = Tree(NODETYPE.CONSTANT, f'1_{diff.companion.new_constant()}', companion=diff.companion)
+        x_squared = node.companion.new_node(NODETYPE.POWER, '^', node.right, const1)
+        const2 = node.companion.new_node(NODETYPE.CONSTANT, f'1_{node.companion.new_constant()}')
         const2.rank = node.right.rank
         const2.axes = node.right.axes
-        inside_root = Tree(NODETYPE.SUM, '+', const2, Tree(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, x_squared, companion=diff.companion), companion=diff.companion)
-        const3 = Tree(NODETYPE.CONSTANT, f'0.5_{diff.companion.new_constant()}', companion=diff.companion)
+        inside_root = node.companion.new_node(NODETYPE.SUM, '+', const2, node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, x_squared))
+        const3 = node.companion.new_node(NODETYPE.CONSTANT, f'0.5_{node.companion.new_constant()}')
         const3.rank = 0
         const3.axes = []
-        funcDiff = Tree(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, Tree(NODETYPE.ELEMENTWISE_FUNCTION, 'elementwise_inverse', None, Tree(NODETYPE.POWER, '^', inside_root, const3, companion=diff.companion), companion=diff.companion), companion=diff.companion)
+        funcDiff = node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, 'elementwise_inverse', None, node.companion.new_node(NODETYPE.POWER, '^', inside_root, const3)))
     elif node.name == 'arctan':
         indices = ''.join([i for i in string.ascii_lowercase][0:node.right.rank])
-        squared = Tree(NODETYPE.PRODUCT, f'*({indices},{indices}->{indices})', node.right, node.right, companion=diff.companion)
+        squared = node.companion.new_node(NODETYPE.PRODUCT, f'*({indices},{indices}->{indices})', node.right, node.right)
         squared.set_indices(indices, indices, indices)
-        const = Tree(NODETYPE.CONSTANT, f'1_{diff.companion.new_constant()}', companion=diff.companion)
+        const = node.companion.new_node(NODETYPE.CONSTANT, f'1_{node.companion.new_constant()}')
         const.rank = node.right.rank
         const.axes = node.right.axes
-        funcDiff = Tree(NODETYPE.ELEMENTWISE_FUNCTION, 'elementwise_inverse', None, Tree(NODETYPE.SUM, '+', squared, const, companion=diff.companion), companion=diff.companion)
+        funcDiff = node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, 'elementwise_inverse', None, node.companion.new_node(NODETYPE.SUM, '+', squared, const))
     elif node.name == 'exp':
-        funcDiff = Tree(NODETYPE.ELEMENTWISE_FUNCTION, 'exp', None, node.right, companion=diff.companion)
+        funcDiff = node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, 'exp', None, node.right)
     elif node.name == 'log':
-        funcDiff = Tree(NODETYPE.ELEMENTWISE_FUNCTION, 'elementwise_inverse', None, node.right, companion=diff.companion)
+        funcDiff = node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, 'elementwise_inverse', None, node.right)
     elif node.name == 'tanh':
         indices = ''.join([i for i in string.ascii_lowercase][0:node.right.rank])
-        squared = Tree(NODETYPE.PRODUCT, f'*({indices},{indices}->{indices})', node, node, companion=diff.companion)
+        squared = node.companion.new_node(NODETYPE.PRODUCT, f'*({indices},{indices}->{indices})', node, node)
         squared.set_indices(indices, indices, indices)
-        const = Tree(NODETYPE.CONSTANT, f'1_{diff.companion.new_constant()}', companion=diff.companion)
+        const = node.companion.new_node(NODETYPE.CONSTANT, f'1_{node.companion.new_constant()}')
         const.rank = node.right.rank
         const.axes = node.right.axes
-        funcDiff = Tree(NODETYPE.SUM, '+', const, Tree(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, squared, companion=diff.companion), companion=diff.companion)
+        funcDiff = node.companion.new_node(NODETYPE.SUM, '+', const, node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, squared))
     elif node.name == 'abs':
-        funcDiff = Tree(NODETYPE.ELEMENTWISE_FUNCTION, 'sign', None, node.right, companion=diff.companion)
+        funcDiff = node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, 'sign', None, node.right)
     elif node.name == 'sign':
-        funcDiff = Tree(NODETYPE.CONSTANT, f'0_{diff.companion.new_constant()}', companion=diff.companion)
+        funcDiff = node.companion.new_node(NODETYPE.CONSTANT, f'0_{node.companion.new_constant()}')
         funcDiff.rank = node.right.rank
         funcDiff.axes = node.right.axes
     elif node.name == 'relu':
-        funcDiff = Tree(NODETYPE.ELEMENTWISE_FUNCTION, 'relu', None, Tree(NODETYPE.ELEMENTWISE_FUNCTION, 'sign', None, node.right, companion=diff.companion), companion=diff.companion)
+        funcDiff = node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, 'relu', None, node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, 'sign', None, node.right))
     elif node.name == 'elementwise_inverse':
         indices = ''.join([i for i in string.ascii_lowercase][0:node.right.rank])
-        squared = Tree(NODETYPE.PRODUCT, f'*({indices},{indices}->{indices})', node.right, node.right, companion=diff.companion)
+        squared = node.companion.new_node(NODETYPE.PRODUCT, f'*({indices},{indices}->{indices})', node.right, node.right)
         squared.set_indices(indices, indices, indices)
-        funcDiff = Tree(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, Tree(NODETYPE.ELEMENTWISE_FUNCTION, 'elementwise_inverse', None, squared, companion=diff.companion), companion=diff.companion)
+        funcDiff = node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, 'elementwise_inverse', None, squared))
     else:
         raise Exception(f'Unknown function {node.name} encountered during differentiation.')
+    return funcDiff
+
+def _diff_special_function(node, diff, args, yRank):
+    funcDiff = _special_derivative(node)
     s1 = ''.join(string.ascii_lowercase[0:node.right.rank])
-    s2 = ''.join([i for i in string.ascii_lowercase if i not in s1][0:yRank])
-    diff = Tree(NODETYPE.PRODUCT, f'*({s2+s1},{s1}->{s2+s1})', diff, funcDiff, companion=diff.companion) # Diff rule
-    diff.set_indices(s2+s1, s1, s2+s1)
-    if node.right and node.right.contains(arg):
-        diff = _contributions(node.right, diff, arg, yRank)
-    return diff
+    s2 = ''.join([i for i in string.ascii_lowercase if i not in s1][0:node.rank])
+    s3 = ''.join([i for i in string.ascii_lowercase if i not in s1+s2][0:yRank])
+    diff = diff.companion.new_node(NODETYPE.PRODUCT, f'*({s3+s2},{s2+s1}->{s3+s1})', diff, funcDiff) # Diff rule
+    diff.set_indices(s3+s2, s2+s1, s3+s1)
+    if node.right and node.right.contains_any(args):
+        yield node.right, diff
 
-def _diff_special_function(node, diff, arg, yRank):
+def _special_derivative(node): # Derivative of inv or det with respect to the matrix, axes of the result first
     if node.name == 'inv':
-        funcDiff = Tree(NODETYPE.PRODUCT, f'*(ij,kl->kjli)', Tree(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, node, companion=diff.companion), node, companion=diff.companion)
+        funcDiff = node.companion.new_node(NODETYPE.PRODUCT, f'*(ij,kl->kjli)', node.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, '-', None, node), node)
         funcDiff.set_indices('ij', 'kl', 'kjli')
     if node.name == 'det':
-        funcDiff = Tree(NODETYPE.PRODUCT, '*(ij,->ji)', Tree(NODETYPE.SPECIAL_FUNCTION, 'adj', None, node.right, companion=diff.companion), Tree(NODETYPE.CONSTANT, f'1_{diff.companion.new_constant()}', companion=diff.companion), companion=diff.companion)
+        funcDiff = node.companion.new_node(NODETYPE.PRODUCT, '*(ij,->ji)', node.companion.new_node(NODETYPE.SPECIAL_FUNCTION, 'adj', None, node.right), node.companion.new_node(NODETYPE.CONSTANT, f'1_{node.companion.new_constant()}'))
         funcDiff.set_indices('ij', '', 'ji')
-    s1 = ''.join(string.ascii_lowercase[0:node.right.rank])
-    s2 = ''.join([i for i in string.ascii_lowercase if i not in s1][0:node.rank])
-    s3 = ''.join([i for i in string.ascii_lowercase if i not in s1+s2][0:yRank])
-    diff = Tree(NODETYPE.PRODUCT, f'*({s3+s2},{s2+s1}->{s3+s1})', diff, funcDiff, companion=diff.companion) # Diff rule
-    diff.set_indices(s3+s2, s2+s1, s3+s1)
-    if node.right and node.right.contains(arg):
-        diff = _contributions(node.right, diff, arg, yRank)
-    return diff
+    return funcDiff
 
-def _diff_variable(node, diff, arg):
-    if node == arg:
+def _diff_variable(node, diff, args):
+    if node in args:
         pass
     else:
         raise Exception('Reached non-argument variable during differentiation.')
     return diff
     
-def _contributions(node, diff, arg, yRank):
-    global _originalNodeToDiffNode
-    global _originalNodeToDiffTree
-    if node in _originalNodeToDiffNode:   # If we've been to this node before, we need to add the new contribution to the old one
-        diff = Tree(NODETYPE.SUM, '+', _originalNodeToDiffNode[node], diff, companion=diff.companion)
-        savedDiffNode = _originalNodeToDiffNode[node]   # Need this in a second
-        _originalNodeToDiffNode[node] = diff   # Future contributions need to be added here
-        # When we add a new contribution to dY/dX (diff), we also need to incorporate this contribution in dX/dZ for any child nodes Z of X
-        _originalNodeToDiffTree[node].add_incoming_edges()
-        for n in savedDiffNode.incoming:
-            if n.left == savedDiffNode:
-                n.left = diff
-            elif n.right == savedDiffNode:
-                n.right = diff
-        if len(savedDiffNode.incoming) != 0:
-            diff = _originalNodeToDiffTree[node]
+def _simplify(dag, recursive=False):
+    if recursive:
+        _simplify_recursive(dag)
     else:
-        _originalNodeToDiffNode[node] = diff
-        diff = _reverse_mode_diff(node, diff, arg, yRank)
-        _originalNodeToDiffTree[node] = diff
-    return diff
+        for node in list(dag.postorder()): # Children get simplified before their parents
+            _simplify_node(node)
+
+def _simplify_recursive(node):
+    if node.left: _simplify_recursive(node.left)
+    if node.right: _simplify_recursive(node.right)
+    _simplify_node(node)
 
-def _simplify(node):
-    if node.left: _simplify(node.left)
-    if node.right: _simplify(node.right)
+def _simplify_node(node):
     node_changed = True
     while(node_changed):
         node_changed = False
         if _is_simplifiable_sum_minus_1(node): # Simplify (a + (- b)) to (a - b)
             node.type = NODETYPE.DIFFERENCE
             node.name = '-'
-            node.right = node.right.right
+            node.set_right(node.right.right)
             node_changed = True
         if _is_simplifiable_power(node): # Simplify exp(b * log(a)) to (a ^ b)
             node.type = NODETYPE.POWER
             node.name = '^'
-            node.left = node.right.left
-            node.right = node.right.right.right
+            node.set_left(node.right.left)
+            node.set_right(node.right.right.right)
             node_changed = True
         if _is_simplifiable_adj(node): # Simplify det(X) * inv(X) = adj(X)
             node.type = NODETYPE.SPECIAL_FUNCTION
             node.name = 'adj'
-            node.left = None
-            node.right = node.right.right
+            node.set_left(None)
+            node.set_right(node.right.right)
             node_changed = True
         if _is_simplifiable_const_minus(node): # Turn (- (const)) into a const with a minus
             node.type = NODETYPE.CONSTANT
@@ -334,14 +640,14 @@ def _simplify(node):
                 node.name = node.right.name.strip('-')
             else:
                 node.name = '-' + node.right.name
-            node.left = None
-            node.right = None
+            node.set_left(None)
+            node.set_right(None)
             node_changed = True
         if _is_simplifiable_const_sum(node): # Compute sum of constants
             node.type = NODETYPE.CONSTANT
-            node.name = str(int(node.left.name.split('_')[0]) + int(node.right.name.split('_')[0]))
-            node.left = None
-            node.right = None
+            node.name = _constant_name(float(node.left.name.split('_')[0]) + float(node.right.name.split('_')[0]))
+            node.set_left(None)
+            node.set_right(None)
             node_changed = True
         if _is_simplifiable_const_sum_minus(node): # Simplify (a + b) to (a - (-b)) when b is a const and has a -
             node.type = NODETYPE.DIFFERENCE
@@ -350,10 +656,13 @@ def _simplify(node):
             node_changed = True
         if _is_simplifiable_const_diff(node): # Compute difference of constants
             node.type = NODETYPE.CONSTANT
-            node.name = str(int(node.left.name.split('_')[0]) - int(node.right.name.split('_')[0]))
-            node.left = None
-            node.right = None
+            node.name = _constant_name(float(node.left.name.split('_')[0]) - float(node.right.name.split('_')[0]))
+            node.set_left(None)
+            node.set_right(None)
             node_changed = True
+        if node_changed: # The type changes as well, not only the children
+            node.update_variables()
+            node.mark_modified()
 
 def _is_simplifiable_sum_minus_1(node):
     return  node.type == NODETYPE.SUM and \
@@ -397,6 +706,9 @@ def _is_simplifiable_const_diff(node):
             node.left.type == NODETYPE.CONSTANT and \
             node.right.type == NODETYPE.CONSTANT
 
+def _constant_name(value): # Integral values keep the name of an integer, like 0.5 + 0.5 = 1
+    return str(int(value)) if value.is_integer() else str(value)
+
 if __name__ == '__main__':
     example= '''
         declare x 1 expression tanh(x) derivative wrt x
@@ -1,16 +1,24 @@
 import unittest
-from differentiator import differentiate
+from differentiator import differentiate, differentiate_dag, differentiate_batch, Differentiator, hessian, hessian_vector_product, mode_costs, choose_mode, _preprocess
+from differentiator import vector_jacobian_product, jacobian_vector_product
+from exporttree import python_code, python_function, python_function_code, axis_sizes
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from parser import parse
-from tree import Tree
-from numcheck import numcheck
+from tree import Tree, NODETYPE, TreeCompanion
+from numcheck import numcheck, _batched_approximation, _loop_approximation
 
 class DifferentiationTests(unittest.TestCase):
-    numcheck_h = 1e-9
+    numcheck_h = 1e-6
     numcheck_err_limit = 1e-6
 
     def reset_tree_attributes(self):
         pass
 
+    def evaluate(self, dag, values):
+        f = python_function(dag, list(values.keys()))
+        return f(*values.values())
+
     def test_base(self):
         self.reset_tree_attributes()
         test = 'declare a 0 expression a derivative wrt a'
@@ -423,5 +431,340 @@ class DifferentiationTests(unittest.TestCase):
         self.assertEqual(str(d), '4')
         self.assertTrue(numcheck(originalDag, d, variable_ranks, arg_name, h=self.numcheck_h, err_limit=self.numcheck_err_limit))
 
+    def test_simplification_incoming_edges(self): # Simplified nodes leave no parents behind that don't point to them anymore
+        self.reset_tree_attributes()
+        tests = ['declare x 0 expression x^2 derivative wrt x',
+                 'declare x 0 expression 2 *(,->) (x+x) derivative wrt x',
+                 'declare X 2 expression det(X) derivative wrt X',
+                 'declare a 0 b 0 expression a - b *(,->) a *(,->) a derivative wrt a']
+        for test in tests:
+            d, originalDag, arg_name, variable_ranks = differentiate(test)
+            for node in d.postorder():
+                self.assertTrue(all(parent.left is node or parent.right is node for parent in node.incoming))
+
+    def test_deep_expression(self):
+        self.reset_tree_attributes()
+        test = 'declare x 1 expression tanh(x)' + ''.join(f' + {i}' for i in range(5000)) + ' derivative wrt x'
+        d, originalDag, arg_name, variable_ranks = differentiate(test)
+        self.assertEqual(str(d), '(delta(1) *(ba,a->ba) (1 - ((tanh(x)) *(a,a->a) (tanh(x)))))')
+
+    def test_deep_nested_functions(self): # Built directly, since the parser recurses into parentheses
+        self.reset_tree_attributes()
+        companion = TreeCompanion()
+        dag = companion.new_node(NODETYPE.VARIABLE, 'x')
+        for i in range(20000):
+            dag = companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, 'sin', None, dag)
+        d, originalDag = differentiate_dag(dag, 'x', {'x': 0})
+        value, derivative = 0.5, 1
+        for i in range(20000):
+            value, derivative = np.sin(value), derivative * np.cos(value)
+        self.assertTrue(np.isclose(python_function(originalDag, ['x'])(0.5), value))
+        self.assertTrue(np.isclose(python_function(d, ['x'])(0.5), derivative))
+
+    def test_recursive_passes(self):
+        self.reset_tree_attributes()
+        tests = ['declare a 0 b 0 expression a - b - a derivative wrt a',
+                 'declare X 2 expression adj(X) *(ij,ij->) adj(X) derivative wrt X',
+                 'declare x 1 A 2 expression A *(ij,j->i) tanh(A *(ij,j->i) x) derivative wrt x']
+        for test in tests:
+            d, _, _, _ = differentiate(test)
+            d_recursive, _, _, _ = differentiate(test, recursive=True)
+            self.assertEqual(str(d), str(d_recursive))
+
+    def test_differentiator_object(self):
+        self.reset_tree_attributes()
+        test = 'declare a 0 b 0 expression (b*(,->)a) *(,->) a derivative wrt a'
+        differentiator = Differentiator()
+        d, _, _, _ = differentiator.differentiate(test)
+        d_again, _, _, _ = differentiator.differentiate(test)
+        self.assertEqual(str(d), '((a *(,->) b) + (b *(,->) a))')
+        self.assertEqual(str(d), str(d_again))
+
+    def test_concurrent_differentiation(self):
+        self.reset_tree_attributes()
+        tests = ['declare a 0 b 0 expression a - b - a derivative wrt a',
+                 'declare X 2 expression adj(X) *(ij,ij->) adj(X) derivative wrt X',
+                 'declare x 1 A 2 expression A *(ij,j->i) tanh(A *(ij,j->i) x) derivative wrt x',
+                 'declare a 2 X 4 expression a*(ij,ijkl->ijkl)X + cos(X) derivative wrt X'] * 4
+        serial = [str(differentiate(test)[0]) for test in tests]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            self.assertEqual([str(d) for d, _, _, _ in executor.map(differentiate, tests)], serial)
+        self.assertEqual([str(d) for d, _, _, _ in differentiate_batch(tests, processes=False)], serial)
+        results = differentiate_batch(tests, max_workers=2)
+        self.assertEqual([str(d) for d, _, _, _ in results], serial)
+        d, originalDag, arg_name, variable_ranks = results[2]
+        self.assertTrue(numcheck(originalDag, d, variable_ranks, arg_name, h=self.numcheck_h, err_limit=self.numcheck_err_limit))
+
+    def test_multiple_arguments(self):
+        self.reset_tree_attributes()
+        test = 'declare x 1 A 2 b 1 expression b *(i,i->) tanh(A *(ij,j->i) x) + A *(ij,ij->) A derivative wrt x, A, b, c'
+        ds, originalDag, arg_names, variable_ranks = differentiate(test)
+        self.assertEqual(arg_names, ['x', 'A', 'b', 'c'])
+        for d, arg_name in zip(ds, arg_names):
+            single, _, _, _ = differentiate(test.split('wrt')[0] + f'wrt {arg_name}')
+            self.assertEqual(str(d), str(single))
+            if arg_name != 'c':
+                self.assertTrue(numcheck(originalDag, d, variable_ranks, arg_name, h=self.numcheck_h, err_limit=self.numcheck_err_limit))
+        self.assertEqual(str(ds[3]), '0')
+
+    def test_multiple_arguments_shared_adjoints(self):
+        self.reset_tree_attributes()
+        tests = ['declare X 2 Y 2 expression adj(X) *(ij,ij->) adj(Y*(ij,jk->ik)X) derivative wrt X, Y',
+                 'declare a 0 b 0 expression a ^ b derivative wrt a, b',
+                 'declare a 1 b 1 expression a *(i,j->) b derivative wrt a, b']
+        for test in tests:
+            for recursive in [False, True]:
+                ds, originalDag, arg_names, variable_ranks = differentiate(test, recursive)
+                for d, arg_name in zip(ds, arg_names):
+                    self.assertTrue(numcheck(originalDag, d, variable_ranks, arg_name, h=self.numcheck_h, err_limit=self.numcheck_err_limit))
+
+    def test_multiple_arguments_repeated_contributions(self): # Contributions that reach an ancestor of an argument after the argument was reached
+        self.reset_tree_attributes()
+        test = 'declare x 1 y 1 expression (y + x) + (y + x) derivative wrt y, x'
+        values = {'x': np.random.rand(3), 'y': np.random.rand(3)}
+        for recursive in [False, True]:
+            ds, originalDag, arg_names, variable_ranks = differentiate(test, recursive)
+            for d in ds:
+                self.assertTrue(np.array_equal(self.evaluate(d, values), 2 * np.eye(3)))
+
+    def test_hessian(self):
+        self.reset_tree_attributes()
+        test = 'declare x 0 expression x ^ 3 derivative wrt x'
+        h, d, originalDag, arg_name, variable_ranks = hessian(test)
+        self.assertEqual(str(h), '(3 *(,->) (2 *(,->) (x ^ 1)))')
+        tests = ['declare x 1 A 2 expression tanh(A *(ij,j->i) x) *(i,i->) x derivative wrt x',
+                 'declare x 1 expression sin(x) *(i,i->) cos(x) derivative wrt x',
+                 'declare X 2 expression det(X) derivative wrt X',
+                 'declare a 0 b 0 expression a - b *(,->) a *(,->) a derivative wrt a',
+                 'declare x 1 expression arcsin(x *(i,->i) 0.5) *(i,i->) arccos(x *(i,->i) 0.5) derivative wrt x'] # Halved, the second derivatives get large close to 1
+        for test in tests:
+            for recursive in [False, True]:
+                h, d, originalDag, arg_name, variable_ranks = hessian(test, recursive)
+                self.assertEqual(h.rank, 2 * variable_ranks[arg_name])
+                self.assertTrue(numcheck(d, h, variable_ranks, arg_name, h=1e-7, err_limit=1e-4))   # The Hessian is the derivative of the gradient
+        test = 'declare x 1 expression exp(x) *(i,->i) (x *(i,i->) x) derivative wrt x'    # y_i = exp(x_i) s with s = x_j x_j
+        x = np.random.rand(3)
+        e, s, I = np.exp(x), x @ x, np.eye(3)
+        analytic = np.einsum('ij,ik,i->ijk', I, I, e * s) + 2 * np.einsum('i,ij,k->ijk', e, I, x) + 2 * np.einsum('i,ik,j->ijk', e, I, x) + 2 * np.einsum('i,jk->ijk', e, I)
+        for recursive in [False, True]:
+            h, d, originalDag, arg_name, variable_ranks = hessian(test, recursive)
+            self.assertTrue(np.allclose(self.evaluate(h, {'x': x}), analytic))
+        for test, rank in [('declare x 1 expression x derivative wrt x', 3), ('declare A 2 expression A derivative wrt A', 6)]: # The gradient doesn't contain the argument
+            h, d, originalDag, arg_name, variable_ranks = hessian(test)
+            self.assertEqual(h.rank, rank)
+            self.assertTrue(np.array_equal(self.evaluate(h, {arg_name: np.ones((3,) * variable_ranks[arg_name])}), np.zeros((3,) * rank)))
+
+    def test_differentiate_dag_keeps_input(self): # Differentiating a derivative again doesn't rewrite the derivative the caller holds
+        self.reset_tree_attributes()
+        d, originalDag, arg_name, variable_ranks = differentiate('declare A 2 expression det(A) derivative wrt A')
+        printed, nodes = str(d), list(d.postorder())
+        h, d2 = differentiate_dag(d, arg_name, variable_ranks)
+        self.assertEqual(str(d), printed)
+        self.assertEqual(list(d.postorder()), nodes)
+        self.assertTrue(numcheck(d, h, variable_ranks, arg_name, h=1e-7, err_limit=1e-4))
+
+    def test_hessian_vector_product(self):
+        self.reset_tree_attributes()
+        tests = ['declare x 1 A 2 expression tanh(A *(ij,j->i) x) *(i,i->) x derivative wrt x',
+                 'declare x 1 expression exp(x) *(i,i->) sin(x) derivative wrt x',
+                 'declare X 2 expression det(X) derivative wrt X',
+                 'declare x 1 expression arcsin(x *(i,->i) 0.5) *(i,i->) arccos(x *(i,->i) 0.5) derivative wrt x'] # Halved, the second derivatives get large close to 1
+        for i, test in enumerate(tests):
+            hvp, directional, originalDag, arg_name, variable_ranks = hessian_vector_product(test, 'v')
+            self.assertEqual(variable_ranks['v'], variable_ranks[arg_name])
+            self.assertEqual(hvp.rank, variable_ranks[arg_name])
+            if i != 2: # No node has the rank of the Hessian (the derivative of inv(X) in det(X) has it by itself)
+                self.assertTrue(all(node.rank < 2 * variable_ranks[arg_name] for node in hvp.postorder() if node.type != NODETYPE.VARIABLE))
+            self.assertTrue(numcheck(directional, hvp, variable_ranks, arg_name, h=1e-7, err_limit=1e-4))
+        self.assertRaises(Exception, hessian_vector_product, 'declare x 1 v 1 expression x *(i,i->) v derivative wrt x', 'v')
+
+    def test_forward_mode(self):
+        self.reset_tree_attributes()
+        test = 'declare x 0 A 2 expression sin(x *(,ij->ij) A) derivative wrt x'
+        d, originalDag, arg_name, variable_ranks = differentiate(test, mode='forward')
+        self.assertEqual(str(d), '((cos((x *(,ij->ij) A))) *(ab,ab->ab) A)')
+        tests = ['declare x 1 A 2 expression tanh(A *(ij,j->i) x) *(i,i->) x derivative wrt x',
+                 'declare a 0 x 0 expression a ^ x derivative wrt x',
+                 'declare X 2 expression adj(X) *(ij,ij->) adj(X) derivative wrt X',
+                 'declare a 1 b 1 expression a *(i,j->) b derivative wrt a',
+                 'declare x 1 A 2 b 1 expression b *(i,i->) tanh(A *(ij,j->i) x) + A *(ij,ij->) A derivative wrt x, A, b']
+        for test in tests:
+            ds, originalDag, arg_names, variable_ranks = differentiate(test, mode='forward')
+            if not isinstance(ds, list):
+                ds, arg_names = [ds], [arg_names]
+            for d, arg_name in zip(ds, arg_names):
+                self.assertTrue(numcheck(originalDag, d, variable_ranks, arg_name, h=self.numcheck_h, err_limit=self.numcheck_err_limit))
+
+    def test_mode_selection(self):
+        self.reset_tree_attributes()
+        test = 'declare x 1 A 2 expression A *(ij,j->i) x derivative wrt x'
+        originalDag, arg_name, variable_ranks = parse(test)
+        originalDag, args = _preprocess(originalDag, [arg_name], variable_ranks)
+        self.assertEqual(mode_costs(originalDag, args), (18, 18))
+        self.assertEqual(choose_mode(originalDag, args), 'reverse')    # Ties stay with reverse mode
+        self.assertEqual(choose_mode(originalDag, args, {'A': (100, 2)}), 'forward')    # Long output, short argument
+        self.assertEqual(choose_mode(originalDag, args, {'A': (2, 100)}), 'reverse')
+        test = 'declare x 0 A 2 expression sin(x *(,ij->ij) A) derivative wrt x'
+        d, _, _, _ = Differentiator(mode='auto').differentiate(test)
+        d_forward, _, _, _ = differentiate(test, mode='forward')
+        self.assertEqual(str(d), str(d_forward))
+        self.assertRaises(Exception, Differentiator, mode='sideways')
+
+    def test_vector_jacobian_product(self):
+        self.reset_tree_attributes()
+        tests = ['declare x 1 A 2 expression tanh(A *(ij,j->i) x) derivative wrt x',
+                 'declare x 1 A 2 expression A *(ij,j->i) x + x derivative wrt A',
+                 'declare x 1 expression sin(x) *(i,i->) x derivative wrt x',
+                 'declare x 1 A 2 expression x derivative wrt A']
+        for test in tests:
+            d, originalDag, arg_name, variable_ranks = differentiate(test)
+            values = {name: np.random.random_sample((3,) * rank) for name, rank in variable_ranks.items()}
+            jacobian = self.evaluate(d, values)
+            vjp, originalDag, arg_name, variable_ranks = vector_jacobian_product(test, 'u')
+            self.assertEqual(variable_ranks['u'], originalDag.rank)
+            self.assertEqual(vjp.rank, variable_ranks[arg_name])
+            self.assertFalse(any(node.type == NODETYPE.DELTA for node in vjp.postorder()))
+            values['u'] = np.random.random_sample((3,) * originalDag.rank)
+            self.assertEqual(np.shape(self.evaluate(vjp, values)), (3,) * variable_ranks[arg_name])
+            self.assertTrue(np.allclose(self.evaluate(vjp, values), np.tensordot(values['u'], jacobian, axes=originalDag.rank)))
+        vjp, _, _, _ = vector_jacobian_product('declare x 1 A 2 expression tanh(A *(ij,j->i) x) derivative wrt x')
+        self.assertEqual(str(vjp), '((u *(a,a->a) (1 - ((tanh((A *(ij,j->i) x))) *(a,a->a) (tanh((A *(ij,j->i) x)))))) *(i,ij->j) A)')
+
+    def test_jacobian_vector_product(self):
+        self.reset_tree_attributes()
+        tests = ['declare x 1 A 2 expression tanh(A *(ij,j->i) x) derivative wrt x',
+                 'declare x 1 A 2 expression A *(ij,j->i) x + x derivative wrt A',
+                 'declare X 2 expression inv(X) derivative wrt X',
+                 'declare x 1 A 2 expression x derivative wrt A']
+        for test in tests:
+            d, originalDag, arg_name, variable_ranks = differentiate(test)
+            values = {name: np.random.random_sample((3,) * rank) for name, rank in variable_ranks.items()}
+            jacobian = self.evaluate(d, values)
+            jvp, originalDag, arg_name, variable_ranks = jacobian_vector_product(test, 'v')
+            self.assertEqual(variable_ranks['v'], variable_ranks[arg_name])
+            self.assertEqual(jvp.rank, originalDag.rank)
+            values['v'] = np.random.random_sample((3,) * variable_ranks[arg_name])
+            self.assertEqual(np.shape(self.evaluate(jvp, values)), (3,) * originalDag.rank)
+            self.assertTrue(np.allclose(self.evaluate(jvp, values), np.tensordot(jacobian, values['v'], axes=variable_ranks[arg_name])))
+        self.assertRaises(Exception, jacobian_vector_product, 'declare x 1 v 1 expression x derivative wrt x', 'v')
+
+    def test_python_function(self):
+        self.reset_tree_attributes()
+        test = 'declare x 1 A 2 expression A *(ij,j->i) tanh(A *(ij,j->i) x) derivative wrt x'
+        diffDag, originalDag, arg_name, variable_ranks = differentiate(test)
+        values = {'x': np.random.random_sample((3,)), 'A': np.random.random_sample((3,3))}
+        for dag in [originalDag, diffDag]:
+            expected = eval(f'lambda x,A: {python_code(dag)}')(values['x'], values['A'])
+            self.assertTrue(np.allclose(python_function(dag, ['x', 'A'])(values['x'], values['A']), expected))
+        code = python_function_code(diffDag, ['x', 'A'], optimize=False)
+        self.assertEqual(code.count('np.tanh('), 1) # The shared tanh node gets computed once
+        self.assertEqual(code.count(' = '), len([node for node in diffDag.postorder() if node.type != NODETYPE.VARIABLE]))
+        self.assertTrue(code.startswith('def f(x,A):'))
+
+    def test_python_function_deep(self):
+        self.reset_tree_attributes()
+        test = 'declare x 0 expression ' + '+'.join(['sin(x)'] * 2000) + ' derivative wrt x'
+        diffDag, originalDag, arg_name, variable_ranks = differentiate(test)
+        self.assertTrue(np.isclose(python_function(originalDag, ['x'])(0.5), 2000 * np.sin(0.5)))
+        self.assertTrue(np.isclose(python_function(diffDag, ['x'])(0.5), 2000 * np.cos(0.5)))
+
+    def test_batched_python_function(self):
+        tests = ['declare x 1 A 2 expression A *(ij,j->i) tanh(A *(ij,j->i) x) derivative wrt x',
+                 'declare X 2 expression adj(X) derivative wrt X',
+                 'declare X 2 expression det(X) derivative wrt X',
+                 'declare x 1 expression x *(i,->i) 2 derivative wrt x',
+                 'declare x 1 y 0 expression exp(x) *(i,->i) y + x derivative wrt y',
+                 'declare x 0 a 1 expression a^x derivative wrt x']
+        for test in tests:
+            self.reset_tree_attributes()
+            diffDag, originalDag, arg_name, variable_ranks = differentiate(test)
+            names = list(variable_ranks.keys())
+            batch = {name: np.random.random_sample((5,) + (3,) * variable_ranks[name]) for name in names}
+            for dag in [originalDag, diffDag]:
+                for optimize in [True, False]:
+                    f = python_function(dag, names, optimize=optimize)
+                    expected = np.stack([f(*[batch[name][entry] for name in names]) for entry in range(5)])
+                    batched = python_function(dag, names, optimize=optimize, batched=names)
+                    self.assertTrue(np.allclose(batched(*batch.values()), expected))
+                    first_batched = python_function(dag, names, optimize=optimize, batched=names[:1]) # Only the first variable has a batch axis
+                    expected = np.stack([f(batch[names[0]][entry], *[batch[name][0] for name in names[1:]]) for entry in range(5)])
+                    self.assertTrue(np.allclose(first_batched(batch[names[0]], *[batch[name][0] for name in names[1:]]), expected))
+
+    def test_numcheck_modes(self):
+        self.reset_tree_attributes()
+        diffDag, originalDag, arg_name, variable_ranks = differentiate('declare x 1 A 2 expression A *(ij,j->i) tanh(A *(ij,j->i) x) derivative wrt A')
+        for mode in ['full', 'directional', 'loop']:
+            self.assertTrue(numcheck(originalDag, diffDag, variable_ranks, arg_name, h=self.numcheck_h, err_limit=self.numcheck_err_limit, mode=mode))
+        self.assertTrue(numcheck(originalDag, diffDag, variable_ranks, arg_name, h=self.numcheck_h, err_limit=self.numcheck_err_limit, memory_limit=1))
+        wrongDag = differentiate('declare x 1 expression cos(x) derivative wrt x')[0]
+        originalDag = differentiate('declare x 1 expression sin(x) derivative wrt x')[1]
+        for mode in ['full', 'directional', 'loop']:
+            self.assertFalse(numcheck(originalDag, wrongDag, {'x': 1}, 'x', h=self.numcheck_h, err_limit=self.numcheck_err_limit, mode=mode))
+        wrongDag = differentiate('declare x 1 expression ((sin(x) + tanh(x)) + tanh(x)) + tanh(x) derivative wrt x')[0] # Larger than the real derivative everywhere
+        originalDag = differentiate('declare x 1 expression (sin(x) + tanh(x)) + tanh(x) derivative wrt x')[1]
+        for mode in ['full', 'directional', 'loop']:
+            self.assertFalse(numcheck(originalDag, wrongDag, {'x': 1}, 'x', h=self.numcheck_h, err_limit=self.numcheck_err_limit, mode=mode))
+        for input in ['declare a 0 expression a derivative wrt a', 'declare x 1 expression x derivative wrt x', 'declare X 2 expression X *(ij,->ji) 1 derivative wrt X']:
+            diffDag, originalDag, arg_name, variable_ranks = differentiate(input)   # f returns its argument or a view of it
+            for mode in ['full', 'directional', 'loop']:
+                self.assertTrue(numcheck(originalDag, diffDag, variable_ranks, arg_name, h=self.numcheck_h, err_limit=self.numcheck_err_limit, mode=mode))
+        self.assertRaises(Exception, numcheck, originalDag, wrongDag, {'x': 1}, 'x', mode='forward')
+
+    def test_batched_approximation(self):
+        self.reset_tree_attributes()
+        diffDag, originalDag, arg_name, variable_ranks = differentiate('declare X 2 y 1 expression sin(X *(ij,j->i) y) derivative wrt X')
+        X, y = np.random.random_sample((3,3)), np.random.random_sample((3,))
+        looped = _loop_approximation(lambda X: python_function(originalDag, ['X', 'y'])(X, y), X, 1e-6)
+        for memory_limit in [1, 1000, 2**26]:    # One perturbation per evaluation, a few and all at once
+            batched = _batched_approximation(lambda X: python_function(originalDag, ['X', 'y'], batched=['X'])(X, y), X, 1e-6, memory_limit)
+            self.assertTrue(np.allclose(batched, looped))
+
+    def test_varying_python_function(self):
+        self.reset_tree_attributes()
+        diffDag, originalDag, arg_name, variable_ranks = differentiate('declare A 2 B 2 x 1 expression A *(ij,jk->ik) inv(B) *(ik,k->i) x derivative wrt x')
+        A, B, x = np.random.random_sample((3,3)) + 3 * np.eye(3), np.random.random_sample((3,3)) + 3 * np.eye(3), np.random.random_sample((3,))
+        code = python_function_code(originalDag, ['A', 'B', 'x'], varying=['x'])
+        self.assertLess(code.index('np.linalg.inv(B)'), code.index('def f(x):'))   # inv(B) and its product with A get computed once
+        self.assertEqual(code.split('def f(x):')[1].count('_contract('), 1)
+        f = python_function(originalDag, ['A', 'B', 'x'])
+        f_of_x = python_function(originalDag, ['A', 'B', 'x'], varying=['x'])(A, B, x)
+        for _ in range(3):
+            x = np.random.random_sample((3,))
+            self.assertTrue(np.allclose(f_of_x(x), f(A, B, x)))
+        batched = python_function(originalDag, ['A', 'B', 'x'], batched=['x'], varying=['x'])(A, B, x[np.newaxis])
+        xs = np.random.random_sample((4,3))
+        self.assertTrue(np.allclose(batched(xs), np.stack([f(A, B, x) for x in xs])))
+        f_of_A = python_function(diffDag, ['A', 'B', 'x'], varying=['A'])(A, B, x) # The derivative doesn't depend on x
+        self.assertTrue(np.allclose(f_of_A(2 * A), python_function(diffDag, ['A', 'B', 'x'])(2 * A, B, x)))
+        self.assertRaises(Exception, python_function, originalDag, ['A', 'B', 'x'], batched=['x'], varying=['A'])
+
+    def test_numcheck_shapes(self):
+        self.reset_tree_attributes()
+        diffDag, originalDag, arg_name, variable_ranks = differentiate('declare X 2 A 2 y 1 expression sin(A *(ij,jk->ik) X) *(ik,k->i) y derivative wrt X')
+        for mode in ['full', 'loop']:
+            self.assertTrue(numcheck(originalDag, diffDag, variable_ranks, arg_name, h=1e-6, err_limit=1e-4, mode=mode, shapes={'A': (5,4), 'X': (4,6)}))
+        self.assertTrue(numcheck(originalDag, diffDag, variable_ranks, arg_name, h=1e-6, err_limit=1e-4, sizes={'A[0]': 2, 'y[0]': 7}, axis_length=4))
+        self.assertRaises(Exception, numcheck, originalDag, diffDag, variable_ranks, arg_name, shapes={'A': (5,4), 'X': (3,6)})  # X[0] is the same axis as A[1]
+        self.assertRaises(Exception, numcheck, originalDag, diffDag, variable_ranks, arg_name, shapes={'A': (5,)})
+        self.assertRaises(Exception, numcheck, originalDag, diffDag, variable_ranks, arg_name, shapes={'B': (5,5)})
+        self.assertRaises(Exception, numcheck, originalDag, diffDag, variable_ranks, arg_name, sizes={'A[2]': 5})
+
+    def test_axis_sizes(self):
+        self.reset_tree_attributes()
+        diffDag, originalDag, arg_name, variable_ranks = differentiate('declare x 1 A 2 expression A *(ij,j->i) tanh(A *(ij,j->i) x) derivative wrt x')
+        self.assertEqual(sorted(axis_sizes(originalDag, shapes={'A': (5,5)}).values()), [5])   # A is square, all axes are the same
+        self.assertEqual(axis_sizes(originalDag, sizes={'x[0]': 4}), axis_sizes(originalDag, shapes={'A': (4,4)}))
+        self.assertEqual(axis_sizes(originalDag), {})
+        self.assertEqual(list(axis_sizes(originalDag, default=3).values()), [3])
+        self.assertRaises(Exception, axis_sizes, originalDag, {'A': (5,4)})
+        self.assertRaises(Exception, axis_sizes, originalDag, {'A': (5,5)}, {'x[0]': 4})
+        code = python_function_code(diffDag, ['x', 'A'], shapes={'A': (5,5)})
+        self.assertNotIn('np.shape', code)  # Known lengths are literals
+        diffDag, originalDag, arg_name, variable_ranks = differentiate('declare x 1 A 2 b 0 c 1 expression b *(,i->i) (A *(ij,j->i) x) derivative wrt x')
+        lengths = axis_sizes(originalDag, shapes={'A': (5,4)})
+        self.assertEqual(axis_sizes(originalDag, shapes={'A': (5,4), 'b': (), 'c': (3,)}), lengths) # b has no axes, c isn't used
+        self.assertEqual(axis_sizes(diffDag, shapes={'A': (5,4), 'x': (4,), 'b': (), 'c': (3,)}), axis_sizes(diffDag, shapes={'A': (5,4)}))
+        self.assertRaises(Exception, axis_sizes, originalDag, {'A': (5,4), 'b': (2,)})
+
 if __name__ == '__main__':
     unittest.main()
@@ -3,8 +3,12 @@
 #data: 01.06.2022
 
 import re
+import numpy as np
+from functools import partial
+from string import ascii_letters
 
 from tree import NODETYPE
+from contraction import ContractionPlans, fuse_products
 
 
 op_to_np = {
@@ -25,31 +29,218 @@ op_to_np = {
     'abs': 'np.abs',
     'det': 'np.linalg.det',
     'inv': 'np.linalg.inv',
-    'adj': '(lambda x: np.multiply(np.linalg.det(x), np.linalg.inv(x)))'
+    'adj': '(lambda x: np.multiply(np.expand_dims(np.linalg.det(x),(-2,-1)), np.linalg.inv(x)))' # Also works for stacks of matrices
 }
 
-def _get_missing_axis(dag):
+# Lengths of the unified axes of the dag, from shapes (variable name -> shape) and sizes (axis like 'A[1]' -> length).
+# All other axes get the length default, or no entry if it's None. Lengths that contradict each other, e.g. because the
+# expression uses an axis of A where an axis of B with a different length belongs, raise an exception.
+# Shapes of variables that don't occur in the dag have no axes to give lengths to, they get ignored
+def axis_sizes(dag, shapes=None, sizes=None, default=None):
+    companion = dag.companion
+    variables = {}  # Variable name -> its node
+    for node in dag.postorder():
+        if node.type in [NODETYPE.VARIABLE, NODETYPE.DELTA]:
+            variables.setdefault(node.name, node)
+    given = []      # (axis as written by the caller, axis, length)
+    for name, shape in (shapes or {}).items():
+        if not name in variables:
+            continue
+        if len(shape) != len(variables[name].axes):
+            raise Exception(f'Shape {tuple(shape)} does not fit variable {name} of rank {len(variables[name].axes)}')
+        given += [(f'{name}[{i}]', axis, length) for i, (axis, length) in enumerate(zip(variables[name].axes, shape))]
+    for origin, length in (sizes or {}).items():
+        match = re.fullmatch(r'(\w+)\[(\d+)\]', origin)
+        if not match or not match.group(1) in variables or int(match.group(2)) >= len(variables[match.group(1)].axes):
+            raise Exception(f'Size given for {origin}, which is no axis of a variable in the expression')
+        given.append((origin, variables[match.group(1)].axes[int(match.group(2))], length))
+    lengths = {}
+    origins = {}    # Axis -> where its length came from
+    for origin, axis, length in given:
+        axis = companion.find_axis(axis)
+        if axis in lengths and lengths[axis] != length:
+            raise Exception(f'{origin} has length {length}, but it is the same axis as {origins[axis]}, which has length {lengths[axis]}')
+        lengths[axis] = length
+        origins[axis] = origin
+    if default != None:
+        for node in dag.postorder():
+            for axis in node.axes:
+                lengths.setdefault(companion.find_axis(axis), default)
+    return lengths
+
+
+def _get_missing_axis(dag, batched=(), lengths=None): # Variables in batched have an extra leading axis, axes with known lengths get them as literals
     axis_to_numpy = {}
     for axis, origin in dag.companion.axis_to_origin.items():
         var_name = origin.split('[')[0]
-        index = origin.split('[')[1].split(']')[0]
+        index = int(origin.split('[')[1].split(']')[0]) + (var_name in batched)
         axis_to_numpy[axis] = f'np.shape({var_name})[{index}]'
     for node in dag.get_all_subtrees():
-        if node and node.type == NODETYPE.VARIABLE:
+        if node.type == NODETYPE.VARIABLE:
             for index, axis in enumerate(node.axes):
+               axis = dag.companion.find_axis(axis)
                if not axis in axis_to_numpy:
-                    axis_to_numpy[axis] = f'np.shape({node.name})[{index}]'
+                    axis_to_numpy[axis] = f'np.shape({node.name})[{index + (node.name in batched)}]'
+    for axis, length in (lengths or {}).items():
+        axis_to_numpy[axis] = str(length)
     return axis_to_numpy
 
 
-def python_code(dag):
+def python_code(dag, recursive=False): # recursive=True uses the recursive code generation, for comparison in benchmarks
     axis_to_numpy = _get_missing_axis(dag)
-    return _code(dag, axis_to_numpy)
+    if recursive:
+        return _code(dag, axis_to_numpy)
+    code = {}   # Node -> code for that node, children are done before their parents
+    for node in dag.postorder():
+        code[node] = _node_code(node, axis_to_numpy, lambda child: code[child])
+    return code[dag]
+
+
+# Compiles the dag into a Python function with one assignment per node of the DAG, so shared subtrees get computed once.
+# arguments are the names of the parameters of the function in order, they have to include all variables of the dag
+# optimize=True fuses chains of products into one contraction each and contracts them with plans that get computed once per product
+# and operand shapes, see contraction.py
+# The variables in batched get a leading batch axis, one call then evaluates the dag for every entry of the batch
+# With a list of varying variables, the function computes all nodes that don't depend on them and returns a function of only the varying
+# variables that computes the rest. The values of the varying variables in the first call only give their shapes
+# shapes and sizes give the lengths of axes like for axis_sizes, the code then uses them as literals and plans the contractions right away
+def python_function(dag, arguments, name='f', optimize=True, batched=(), varying=None, shapes=None, sizes=None):
+    plans = ContractionPlans()
+    namespace = {'np': np, '_contract': plans.contract}
+    exec(compile(python_function_code(dag, arguments, name, optimize, batched, varying, shapes, sizes, plans), f'<{name}>', 'exec'), namespace)
+    function = namespace[name]
+    function.contraction_plans = plans
+    return function
+
+
+def python_function_code(dag, arguments, name='f', optimize=True, batched=(), varying=None, shapes=None, sizes=None, plans=None):
+    if varying != None and not set(batched) <= set(varying):
+        raise Exception('Batched variables have to be varying')
+    lengths = axis_sizes(dag, shapes, sizes)
+    axis_to_numpy = _get_missing_axis(dag, batched, lengths)
+    fixed_lines = []    # Assignments of the nodes that don't depend on the varying variables
+    lines = []          # Assignments of all other nodes
+    local_names = {}    # Node -> name of the local variable with its value, names start with _ so they can't clash with the variables of the dag
+    fused = fuse_products(dag) if optimize else {}
+    ones_names = {}     # Delta -> name of the local variable with the tensor of ones that is left of it in fused contractions
+    in_batch = set()    # Nodes whose values have the leading batch axis
+    varies = set()      # Nodes that depend on the varying variables
+    for node in _needed_nodes(dag, fused):
+        if node.type == NODETYPE.VARIABLE:
+            local_names[node] = node.name
+            if node.name in batched:
+                in_batch.add(node)
+            if varying == None or node.name in varying:
+                varies.add(node)
+            continue
+        operands = fused[node][1] if node in fused else [child for child in [node.left, node.right] if child]
+        if any(operand in in_batch for operand in operands): # Elementwise operations and the stacked linear algebra of numpy broadcast over the batch axis
+            in_batch.add(node)
+        if varying == None or any(operand in varies for operand in operands):
+            varies.add(node)
+        statements = lines if node in varies else fixed_lines
+        if node in fused:
+            einsum_string = _batch_einsum_string(fused[node][0], [operand in in_batch for operand in operands])
+            for operand in operands:
+                if operand.type == NODETYPE.DELTA and not operand in ones_names:
+                    ones_names[operand] = f'_t{len(fixed_lines) + len(lines) + 1}'
+                    shape = _get_shape_from_axis(operand, axis_to_numpy)[:operand.rank // 2]
+                    fixed_lines.append(f'{ones_names[operand]} = np.broadcast_to(1.0,({",".join(shape)},))' if shape else f'{ones_names[operand]} = 1.0')
+            operand_names = [_operand_name(operand, indices, local_names, ones_names) for operand, indices in zip(operands, einsum_string.split('->')[0].split(','))]
+            prepare = partial(_prepare_plan, plans, _index_lengths(fused[node][0], operands, lengths, dag.companion))
+            if node in varies and varying != None and len([operand for operand in operands if not operand in varies]) > 1:
+                einsum_string, operand_names = _split_fixed_operands(einsum_string, operand_names, [operand in varies for operand in operands], fixed_lines, len(lines), prepare)
+            prepare(len(fixed_lines) + len(lines) + 1, einsum_string)
+            code = f'_contract({len(fixed_lines) + len(lines) + 1},\'{einsum_string}\',{",".join(operand_names)})'
+        elif node.type == NODETYPE.PRODUCT and node in in_batch:
+            einsum_string = _batch_einsum_string(f'{node.leftIndices},{node.rightIndices}->{node.resultIndices}', [operand in in_batch for operand in operands])
+            code = f'np.einsum(\'{einsum_string}\',{local_names[node.left]},{local_names[node.right]})'
+        else:
+            code = _node_code(node, axis_to_numpy, lambda child: _batch_aligned(local_names[child], child, node, in_batch))
+        local_names[node] = f'_t{len(fixed_lines) + len(lines) + 1}'
+        statements.append(f'{local_names[node]} = {code}')
+    if batched and not dag in in_batch: # The value doesn't depend on the batch, but still gets returned once for every entry
+        batch_size = f'np.shape({next(argument for argument in arguments if argument in batched)})[0]'
+        lines.append(f'return np.broadcast_to({local_names[dag]},({batch_size},)+np.shape({local_names[dag]}))')
+    else:
+        lines.append(f'return {local_names[dag]}')
+    if varying == None:
+        code = [f'def {name}({",".join(arguments)}):'] + [f'    {line}' for line in fixed_lines + lines]
+    else:
+        code = [f'def {name}({",".join(arguments)}):'] + [f'    {line}' for line in fixed_lines]
+        code += [f'    def {name}({",".join(argument for argument in arguments if argument in varying)}):'] + [f'        {line}' for line in lines]
+        code += [f'    return {name}']
+    return '\n'.join(code) + '\n'
+
+
+def _index_lengths(einsum_string, operands, lengths, companion): # Index of a fused contraction -> its length, for the operands whose axes have known lengths
+    index_lengths = {}
+    for operand, indices in zip(operands, einsum_string.split('->')[0].split(',')):
+        axes = [companion.find_axis(axis) for axis in operand.axes[:len(indices)]] # Only the first half of the axes of a delta are left
+        if len(axes) == len(indices) and all(axis in lengths for axis in axes):
+            index_lengths.update((i, lengths[axis]) for i, axis in zip(indices, axes))
+    return index_lengths
+
+
+def _prepare_plan(plans, index_lengths, product, einsum_string): # Contractions of operands with known shapes get planned before the first call
+    inputs = einsum_string.split('->')[0].split(',')
+    if plans != None and all(i in index_lengths for i in ''.join(inputs)):
+        plans.prepare(product, einsum_string, *[tuple(index_lengths[i] for i in indices) for indices in inputs])
+
+
+def _split_fixed_operands(einsum_string, operand_names, varies, fixed_lines, varying_lines, prepare): # Contracts the operands of a fused contraction that don't vary once
+    inputs, result = einsum_string.split('->')
+    inputs = inputs.split(',')
+    fixed = [indices for indices, varying in zip(inputs, varies) if not varying]
+    others = ''.join(indices for indices, varying in zip(inputs, varies) if varying) + result
+    fixed_result = ''.join(i for i in dict.fromkeys(''.join(fixed)) if i in others)
+    fixed_name = f'_t{len(fixed_lines) + varying_lines + 1}'
+    prepare(len(fixed_lines) + varying_lines + 1, f'{",".join(fixed)}->{fixed_result}')
+    fixed_lines.append(f'{fixed_name} = _contract({len(fixed_lines) + varying_lines + 1},\'{",".join(fixed)}->{fixed_result}\',{",".join(name for name, varying in zip(operand_names, varies) if not varying)})')
+    inputs = [fixed_result] + [indices for indices, varying in zip(inputs, varies) if varying]
+    return f'{",".join(inputs)}->{result}', [fixed_name] + [name for name, varying in zip(operand_names, varies) if varying]
+
+
+def _batch_einsum_string(einsum_string, batched_operands): # Adds an index for the batch axis to the batched operands and the result
+    if not any(batched_operands):
+        return einsum_string
+    inputs, result = einsum_string.split('->')
+    batch_index = next(letter for letter in ascii_letters if not letter in einsum_string)
+    inputs = [batch_index + indices if batched else indices for indices, batched in zip(inputs.split(','), batched_operands)]
+    return f'{",".join(inputs)}->{batch_index}{result}'
+
+
+def _batch_aligned(name, child, node, in_batch): # Batched operands of lower rank than the result need the axes numpy would add in front of them behind the batch axis
+    if child in in_batch and node.type != NODETYPE.SPECIAL_FUNCTION and 0 <= child.rank < node.rank:
+        return f'np.expand_dims({name},{tuple(range(1, 1 + node.rank - child.rank))})'
+    return name
+
+
+def _operand_name(operand, indices, local_names, ones_names): # Code for an operand of a fused contraction
+    if operand.type == NODETYPE.DELTA:
+        return ones_names[operand]
+    elif operand.type == NODETYPE.CONSTANT and indices == '':
+        return operand.name.split('_')[0]
+    return local_names[operand]
+
+
+def _needed_nodes(dag, fused): # Nodes whose values the function computes in postorder, without the products and deltas that are part of fused contractions
+    nodes = list(dag.postorder())
+    needed = {dag}
+    for node in reversed(nodes):
+        if node in fused:
+            einsum_string, operands = fused[node]
+            needed.update(operand for operand, indices in zip(operands, einsum_string.split('->')[0].split(',')) if operand.type != NODETYPE.DELTA and
+                          not (operand.type == NODETYPE.CONSTANT and indices == ''))
+        elif node in needed:
+            needed.update(child for child in [node.left, node.right] if child)
+    return [node for node in nodes if node in needed]
 
 
 def _get_shape_from_axis(node, axes):
     shape = []
     for dim in node.axes:
+        dim = node.companion.find_axis(dim) # Nodes outside of the unified DAG can still refer to axes that got merged
         if not dim in axes:
             raise Exception(f'No information for dimension of node {node.name} (axis {dim})')
         else:
@@ -70,20 +261,24 @@ def _delta(delta_node, axes):
 
 
 def _code(t, axes):
+    return _node_code(t, axes, lambda child: _code(child, axes))
+
+
+def _node_code(t, axes, child_code):
     if t.type == NODETYPE.DELTA:
         return _delta(t, axes)
 
     elif t.name in ['+', '-', '^']:
         if t.left:
-            return f'{op_to_np[t.name]}({_code(t.left, axes)},{_code(t.right, axes)})'
+            return f'{op_to_np[t.name]}({child_code(t.left)},{child_code(t.right)})'
         else:
-            return f'{t.name}({_code(t.right, axes)})'
+            return f'{t.name}({child_code(t.right)})'
 
     elif t.type in [NODETYPE.ELEMENTWISE_FUNCTION, NODETYPE.SPECIAL_FUNCTION]: # unary operations store their argument in the right tree
         if t.name in op_to_np:
-            return f'{op_to_np[t.name]}({_code(t.right, axes)})'
+            return f'{op_to_np[t.name]}({child_code(t.right)})'
         elif t.name == 'elementwise_inverse':
-            return f'np.divide(1,{_code(t.right, axes)})'
+            return f'np.divide(1,{child_code(t.right)})'
         else:
             raise NotImplementedError(f'Operation {t.name} is not implemented yet.')
 
@@ -92,11 +287,13 @@ def _code(t, axes):
     elif t.type == NODETYPE.CONSTANT:
         shape = _get_shape_from_axis(t, axes)
         constant_val = t.name.split('_')[0]
-        return f'np.full(({",".join(shape)}),{constant_val})'
+        if shape == []:
+            return constant_val
+        return f'np.broadcast_to({constant_val},({",".join(shape)},))' # A view with zero strides, nothing gets allocated
 
     elif t.type == NODETYPE.PRODUCT:
         einsum_string = f'{t.leftIndices},{t.rightIndices}->{t.resultIndices}'
-        return f'np.einsum(\'{einsum_string}\',{_code(t.left, axes)},{_code(t.right, axes)})'
+        return f'np.einsum(\'{einsum_string}\',{child_code(t.left)},{child_code(t.right)})'
 
     else:
         raise NotImplementedError(f'Operation {t.name} is not implemented yet.')
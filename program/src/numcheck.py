@@ -2,57 +2,55 @@ import numpy as np
 from collections import OrderedDict
 
 from differentiator import differentiate
-from exporttree import python_code
+from exporttree import python_function, python_function_code, axis_sizes
 from tree import NODETYPE
 
 # d:            Differentiator
 # h:            x value difference used for the finite differences approximation
 # err_limit:    Maximum allowed absolute error
 # verbose:      Output lots of intermediate information or not
-def numcheck(originalDag, diffDag, variable_ranks, arg_name, h=1e-8, err_limit=1e-6, verbose=False):
+# mode:         'full' approximates the whole derivative with all perturbations of the argument stacked in a batch, chunked to memory_limit bytes.
+#               'directional' only compares the derivative in one random direction, with two evaluations of the expression, for quick checks of large arguments.
+#               'loop' perturbs one entry of the argument after the other, for comparison
+# shapes:       Variable name -> shape of the values used for it
+# sizes:        Axis like 'A[1]' -> its length, all axes without a shape or size have axis_length
+def numcheck(originalDag, diffDag, variable_ranks, arg_name, h=1e-8, err_limit=1e-6, verbose=False, mode='full', memory_limit=2**26, shapes=None, sizes=None, axis_length=3):
+    if not mode in ['full', 'directional', 'loop']:
+        raise Exception(f'Unknown mode {mode} for the numerical check, expected full, directional or loop')
     if verbose: 
         print('Numerical check')
         print('-----------------')
         print(f'Original expression:   {originalDag}')
         print(f'Derivative expression: {diffDag}')
-    axis_length = 3 # We set all axes to this length
     variable_names = list(variable_ranks.keys())
     (deltas, ranks) = get_deltas_in_input(originalDag)
-    variable_names_string = ','.join(variable_names + deltas)
-    f = eval(f'lambda {variable_names_string}: {python_code(originalDag)}') # Create a function that computes the expression represented by the dag
-    df = eval(f'lambda {variable_names_string}: {python_code(diffDag)}')
+    ranks.update(variable_ranks)
+    variable_shapes = _variable_shapes(originalDag, variable_names + deltas, ranks, shapes, sizes, axis_length)
+    df = python_function(diffDag, variable_names + deltas, shapes=variable_shapes)
     if verbose:
-        print(f'Code generated for original expression:   {python_code(originalDag)}')
-        print(f'Code generated for derivative expression: {python_code(diffDag)}')
+        print(f'Code generated for original expression:\n{python_function_code(originalDag, variable_names + deltas, shapes=variable_shapes)}')
+        print(f'Code generated for derivative expression:\n{python_function_code(diffDag, variable_names + deltas, shapes=variable_shapes)}')
 
     variables = OrderedDict()
-    for variable_name in variable_names:
-        shape = ()
-        for axis in range(variable_ranks[variable_name]):
-            shape += (axis_length,) # Construct a tuple where each entry is the length of the corresponding axis, always axis_length
-        variables[variable_name] = np.random.random_sample(shape) # All variables used in the expression with fitting shapes and random values. All axes have length axis_length
-    for delta in deltas:
-        shape = ()
-        for axis in range(ranks[delta]):
-            shape += (axis_length,)
-        variables[delta] = np.random.random_sample(shape)
-    approx_shape = () # Shape of the output of df
-    for axis in range(diffDag.rank):
-        approx_shape += (axis_length,)
-    df_approx = np.zeros(approx_shape)
+    for name in variable_names + deltas:
+        variables[name] = np.random.random_sample(variable_shapes[name]) # All variables used in the expression with fitting shapes and random values
 
+    # The perturbations only change the argument, so the values of all nodes that don't depend on it get computed once
     X = variables[arg_name]
-    it = np.nditer(X, flags=['multi_index']) # Iterator with a multi-index over all elements in the argument
-    for entry in it: #  One iteration = Approximate the derivative of f with respect to one entry of X
-        original_value = X[it.multi_index]
-        X[it.multi_index] = original_value + h # Add h to the current entry
-        f_x_plus_h = f(*variables.values()) # the * operator unpacks the list into separate function arguments
-        X[it.multi_index] = original_value - h
-        f_x_minus_h = f(*variables.values())
-        X[it.multi_index] = original_value
-        df_approx[(...,) + it.multi_index] = (f_x_plus_h - f_x_minus_h) / (2*h)
+    cone_values = [X[np.newaxis] if name == arg_name else value for name, value in variables.items()]
+    batched_f = python_function(originalDag, variable_names + deltas, batched=[arg_name], varying=[arg_name], shapes=variable_shapes)(*cone_values) # Takes a stack of values of the argument
+    if mode == 'loop':
+        f_of_X = python_function(originalDag, variable_names + deltas, varying=[arg_name], shapes=variable_shapes)(*variables.values())
+        df_approx = _loop_approximation(f_of_X, X, h)
+    elif mode == 'full':
+        df_approx = _batched_approximation(batched_f, X, h, memory_limit)
     df_computed = df(*variables.values())
-    abs_error = (df_approx - df_computed)
+    if mode == 'directional':
+        direction = np.random.random_sample(np.shape(variables[arg_name]))
+        direction /= max(np.linalg.norm(direction), 1)
+        df_approx = _directional_approximation(batched_f, X, direction, h)
+        df_computed = np.tensordot(df_computed, direction, axes=np.ndim(direction)) # Derivative in the direction
+    abs_error = np.abs(df_approx - df_computed)
     check_passed = np.all(abs_error < err_limit)
     if verbose:
         print(f'Approximate derivative value: {df_approx}')
@@ -62,15 +60,70 @@ def numcheck(originalDag, diffDag, variable_ranks, arg_name, h=1e-8, err_limit=1
         else: print('Check passed')
     return check_passed
 
+def _loop_approximation(f, X, h): # f is a function of only the argument X
+    df_approx = np.zeros(np.shape(f(X)) + np.shape(X)) # Shape of the output of df
+    it = np.nditer(X, flags=['multi_index']) # Iterator with a multi-index over all elements in the argument
+    for entry in it: #  One iteration = Approximate the derivative of f with respect to one entry of X
+        original_value = X[it.multi_index]
+        X[it.multi_index] = original_value + h # Add h to the current entry
+        f_x_plus_h = np.array(f(X), copy=True) # The value of f can be X itself or a view of it, which changes with X
+        X[it.multi_index] = original_value - h
+        f_x_minus_h = np.array(f(X), copy=True)
+        X[it.multi_index] = original_value
+        df_approx[(...,) + it.multi_index] = (f_x_plus_h - f_x_minus_h) / (2*h)
+    return df_approx
+
+def _batched_approximation(batched_f, X, h, memory_limit): # batched_f is a function of only a stack of values of the argument X
+    X = np.asarray(X, dtype=float)
+    f_shape = np.shape(batched_f(X[np.newaxis]))[1:]
+    df_approx = np.zeros((int(np.prod(f_shape)), X.size))
+    _approximate_entries(batched_f, X, h, memory_limit, 0, X.size, df_approx)
+    return df_approx.reshape(f_shape + X.shape)
+
+def _approximate_entries(batched_f, X, h, memory_limit, start, stop, df_approx): # Writes the derivatives for the entries start to stop of X into the columns of df_approx
+    chunk = max(1, memory_limit // (16 * (X.size + df_approx.shape[0]))) # Perturbations per evaluation, every one needs a copy of X and a value of f in both directions
+    for chunk_start in range(start, stop, chunk):
+        indices = np.arange(chunk_start, min(chunk_start + chunk, stop))
+        perturbed = np.tile(X.reshape(1, -1), (2 * len(indices), 1)) # The first half of the batch gets +h, the second half -h
+        perturbed[np.arange(len(indices)), indices] += h
+        perturbed[len(indices) + np.arange(len(indices)), indices] -= h
+        values = batched_f(perturbed.reshape((2 * len(indices),) + X.shape))
+        values = np.reshape(values, (2 * len(indices), -1))
+        df_approx[:, indices] = ((values[:len(indices)] - values[len(indices):]) / (2*h)).T
+
+def _directional_approximation(batched_f, X, direction, h):
+    values = batched_f(np.stack([X + h * direction, X - h * direction]))
+    return (values[0] - values[1]) / (2*h)
+
+def _variable_shapes(originalDag, names, ranks, shapes, sizes, axis_length): # Variable name -> shape, checked against the axes of the expression
+    shapes = dict(shapes or {})
+    unknown = [name for name in shapes if not name in names]
+    if unknown:
+        raise Exception(f'Shapes given for {", ".join(unknown)}, which are not declared')
+    for name, shape in shapes.items():
+        if len(shape) != ranks[name]:
+            raise Exception(f'Shape {tuple(shape)} does not fit variable {name} of rank {ranks[name]}')
+    lengths = axis_sizes(originalDag, shapes, sizes, axis_length)
+    variable_shapes = {}
+    for name in names:
+        node = _has_axes(originalDag, name)
+        if node:
+            variable_shapes[name] = tuple(lengths[originalDag.companion.find_axis(axis)] for axis in node.axes)
+        else:   # Variables that don't occur in the expression, or scalars
+            variable_shapes[name] = tuple(shapes.get(name, (axis_length,) * ranks[name]))
+    return variable_shapes
+
+def _has_axes(dag, name): # The node of the variable (or delta) name in dag, if it occurs there with axes
+    for node in dag.postorder():
+        if node.type in [NODETYPE.VARIABLE, NODETYPE.DELTA] and node.name == name and node.axes:
+            return node
+    return None
+
 def get_deltas_in_input(originalDag):
     deltas = []
     ranks = {}
-    def helper(node):
-        if not node: return
+    for node in originalDag.preorder():
         if node.type == NODETYPE.DELTA and node.name not in deltas:
             deltas.append(node.name)
             ranks[node.name] = node.rank
-        helper(node.left)
-        helper(node.right)
-    helper(originalDag)
     return deltas, ranks
\ No newline at end of file
@@ -1,5 +1,6 @@
 import unittest
-from parser import parse
+from concurrent.futures import ThreadPoolExecutor
+from parser import parse, Parser
 
 class ParserTests(unittest.TestCase):
     def test_base(self):
@@ -17,7 +18,13 @@ class ParserTests(unittest.TestCase):
         self.assertRaises(Exception, parse, test2)
     def test_multiple_arguments(self):
         test = 'declare a 0 b 1 expression a derivative wrt a b'
-        self.assertRaises(Exception, parse, test)
+        self.assertRaisesRegex(Exception, "Expected ',' between the arguments to differentiate with respect to, but found 'b'", parse, test)
+    def test_argument_list(self):
+        test = 'declare a 0 b 1 expression a derivative wrt a, b'
+        _, arg_name, _ = parse(test)
+        self.assertEqual(arg_name, ['a', 'b'])
+        self.assertRaises(Exception, parse, 'declare a 0 b 1 expression a derivative wrt a, a')
+        self.assertRaises(Exception, parse, 'declare a 0 b 1 expression a derivative wrt a,')
     def test_whitespace(self):
         test = '''
             declare
@@ -105,6 +112,48 @@ class ParserTests(unittest.TestCase):
         test = 'declare A 2 expression delta(0) *(,ij->) A  derivative wrt a'
         dag, _, _ = parse(test)
         self.assertEqual(str(dag), '(delta(0) *(,ij->) A)')
+    def test_hash_consing(self):
+        test = 'declare a 1 b 1 expression sin(a*(i,i->)b) + sin(a*(i,i->)b) derivative wrt a'
+        dag, _, _ = parse(test)
+        self.assertIs(dag.left, dag.right)
+        self.assertEqual(str(dag), '((sin((a *(i,i->) b))) + (sin((a *(i,i->) b))))')
+    def test_hash_consing_constants(self):
+        test = 'declare a 0 expression 2 + 2 derivative wrt a'
+        dag, _, _ = parse(test)
+        self.assertIsNot(dag.left, dag.right)
+    def test_compact_nodes(self):
+        test = 'declare a 1 b 1 expression a*(i,j->ij)b derivative wrt a'
+        dag, _, _ = parse(test)
+        self.assertFalse(hasattr(dag, '__dict__'))
+        self.assertEqual(dag.leftIndices + dag.rightIndices + dag.resultIndices, 'ijij')
+    def test_variable_bits(self):
+        test = 'declare a 1 b 1 c 0 expression sin(a*(i,i->)b) + c derivative wrt a'
+        dag, _, _ = parse(test)
+        a = dag.find('a')
+        c = dag.find('c')
+        self.assertTrue(dag.left.contains(a))
+        self.assertFalse(dag.right.contains(a))
+        self.assertFalse(dag.left.contains(c))
+        self.assertIsNone(dag.right.find('a'))
+        dag.add_incoming_edges()
+        dag.left.right.set_right(c) # sin(a *(i,i->) c)
+        self.assertTrue(dag.contains(c))
+        self.assertTrue(dag.left.contains(c))
+        self.assertFalse(dag.left.contains(dag.find('b')))
+    def test_parser_object(self):
+        test = 'declare a 1 b 1 expression a*(i,i->)b derivative wrt a'
+        dag, arg_name, variable_ranks = Parser(test).parse()
+        self.assertEqual(str(dag), '(a *(i,i->) b)')
+        self.assertEqual(arg_name, 'a')
+        self.assertEqual(variable_ranks, {'a': 1, 'b': 1})
+    def test_concurrent_parsing(self):
+        tests = [f'declare a{i} 1 b 1 expression a{i} *(i,i->) b + {i} derivative wrt a{i}' for i in range(200)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(parse, tests))
+        for i, (dag, arg_name, variable_ranks) in enumerate(results):
+            self.assertEqual(str(dag), f'((a{i} *(i,i->) b) + {i})')
+            self.assertEqual(arg_name, f'a{i}')
+            self.assertIs(dag.left.left.companion, dag.companion)
     
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
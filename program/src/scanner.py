@@ -1,4 +1,5 @@
 import string
+import re
 from enum import Enum
 
 class Input():
@@ -60,7 +61,60 @@ KEYWORDS = {
 ELEMENTWISE_FUNCTIONS = {'sin', 'cos', 'tan', 'arcsin', 'arccos', 'arctan', 'tanh', 'exp', 'log', 'abs', 'sign', 'relu'}
 SPECIAL_FUNCTIONS = {'inv', 'det', 'adj'}
 
-class Scanner():
+WHITESPACE = re.escape(string.whitespace)
+# One regex for all tokens, the character classes are ASCII like ALPHA and DIGITS. A number must not be followed by
+# something that Scanner would still read as part of it, such numbers and unknown symbols are matched as errors
+TOKEN_PATTERN = re.compile(f'''[{WHITESPACE}]*(?:
+      (?P<natnum>[0-9]+(?![.eE0-9]))
+    | (?P<constant>[0-9]+(?:\\.[0-9]+(?![eE0-9])|(?:\\.[0-9]+)?[eE][+-]?[0-9]+))
+    | (?P<word>[A-Za-z][A-Za-z0-9]*)
+    | (?P<symbol>[{re.escape(''.join(SYMBOLS.keys()))}])
+    | (?P<error>[^{WHITESPACE}])
+)''', re.VERBOSE)
+WORDS = {word: (id, word) for word, id in KEYWORDS.items()}  # Lowercased word -> token for every word that is not a name
+WORDS.update({function: (TOKEN_ID.ELEMENTWISE_FUNCTION, function) for function in ELEMENTWISE_FUNCTIONS})
+WORDS.update({function: (TOKEN_ID.SPECIAL_FUNCTION, function) for function in SPECIAL_FUNCTIONS})
+
+def tokenize(input): # All tokens of the input up to the first error, and the position of that error (None if there is none)
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(input):
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == 'word':
+            token = WORDS.get(text.lower())
+            if token != None:
+                tokens.append(token)
+            elif text.islower() and text.isalpha():
+                tokens.append((TOKEN_ID.LOWERCASE_ALPHA, text))
+            else:
+                tokens.append((TOKEN_ID.ALPHANUM, text))
+        elif kind == 'symbol':
+            tokens.append((SYMBOLS[text], text))
+        elif kind == 'natnum':
+            tokens.append((TOKEN_ID.NATNUM, text))
+        elif kind == 'constant':
+            tokens.append((TOKEN_ID.CONSTANT, text.replace('E', 'e')))
+        else:
+            return tokens, match.start(kind)
+    tokens.append((TOKEN_ID.NONE, None))
+    return tokens, None
+
+class TokenScanner(): # Same interface as Scanner, but tokenizes the whole input at once, which is much faster on long inputs
+    def __init__(self, input):
+        self.input = input
+        self.tokens, self.error = tokenize(input)
+        self.index = 0
+
+    def get_sym(self):
+        if self.index == len(self.tokens): # Errors only get raised once the parser reaches them, like with Scanner
+            if self.error == None:
+                return self.tokens[-1]
+            Scanner(self.input[self.error:]).get_sym() # Raises the same error as Scanner would
+        token = self.tokens[self.index]
+        self.index += 1
+        return token
+
+class Scanner(): # Reads one character at a time, kept as the reference for TokenScanner
     def __init__(self, input):
         self.input = Input(input)
         self.current = self.input.next()
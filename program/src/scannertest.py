@@ -0,0 +1,46 @@
+import unittest
+from scanner import Scanner, TokenScanner, TOKEN_ID
+
+class ScannerTests(unittest.TestCase):
+    def all_tokens(self, scanner):
+        tokens = []
+        while True:
+            try:
+                desc, ident = scanner.get_sym()
+            except Exception as e:
+                tokens.append(str(e))
+                return tokens
+            tokens.append((desc, ident))
+            if desc == TOKEN_ID.NONE:
+                return tokens
+
+    def assertSameTokens(self, test):
+        self.assertEqual(self.all_tokens(TokenScanner(test)), self.all_tokens(Scanner(test)))
+
+    def test_tokens(self):
+        test = 'DECLARE a 1 B2 0 expression SIN(a) *(i,->i) B2 + 1.5e-3 - 2E4 / 0.25 ^ 3 derivative WRT a'
+        tokens = self.all_tokens(TokenScanner(test))
+        self.assertEqual(tokens[:5], [(TOKEN_ID.DECLARE, 'declare'), (TOKEN_ID.LOWERCASE_ALPHA, 'a'), (TOKEN_ID.NATNUM, '1'),
+                                      (TOKEN_ID.ALPHANUM, 'B2'), (TOKEN_ID.NATNUM, '0')])
+        self.assertIn((TOKEN_ID.ELEMENTWISE_FUNCTION, 'sin'), tokens)
+        self.assertIn((TOKEN_ID.CONSTANT, '1.5e-3'), tokens)
+        self.assertIn((TOKEN_ID.CONSTANT, '2e4'), tokens)
+        self.assertSameTokens(test)
+
+    def test_end_of_input(self):
+        scanner = TokenScanner('  a \n')
+        self.assertEqual(scanner.get_sym(), (TOKEN_ID.LOWERCASE_ALPHA, 'a'))
+        self.assertEqual(scanner.get_sym(), (TOKEN_ID.NONE, None))
+        self.assertEqual(scanner.get_sym(), (TOKEN_ID.NONE, None))
+
+    def test_errors(self):
+        for test in ['a 1.x', '1.', '2e', '2E+b', '3.5e-', 'a $ b', '1.5.2', '4e2.1', 'x 2ex']:
+            self.assertSameTokens(test)
+        scanner = TokenScanner('a ; b')
+        scanner.get_sym()
+        with self.assertRaises(Exception) as context:
+            scanner.get_sym()
+        self.assertEqual(str(context.exception), 'Symbol ; not allowed.')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,20 +16,54 @@ class NODETYPE(Enum):
     POWER = 'power'
     DELTA = 'delta'
 
+# Flags for nodes whose rank or axes have to be inferred (again), because they are new or got rewritten
+RANK_STALE = 1
+AXES_STALE = 2
+STALE = RANK_STALE | AXES_STALE
+
 class TreeCompanion(): # Since trees are recursive datastructures, we use this companion class to store information about them
     def __init__(self):
         self.node_counter = 0           # Running id for nodes, just used for the visualization
         self.axes_counter = 1           # Running id for axes
         self.axis_to_origin = {}        # Axis -> Name of node from which that axis originated, along with the index of that axis in the original node
+        self.axis_parent = {}           # Union-find forest of unified axes: Axis -> axis it got unified with, representatives have no entry
         self.constant_counter = 0       # Running id for constants
         self.delta_counter = 0          # Running id for deltas
         self.printing_constants = {}    # A dict for saving constants that only get created during printing and their axes 
                                         # (this is for convenience when transforming elementwise_inverse(x) to 1/x during printing)
+        self.node_table = {}            # Hash-consing table: structure of a node -> the one node with that structure
+        self.variable_bits = {}         # Variable name -> bit that marks nodes depending on that variable
+
+    def __getstate__(self): # Pickling (e.g. results of a process pool) leaves out the hash-consing table, it only speeds up building new nodes
+        state = self.__dict__.copy()
+        state['node_table'] = {}
+        return state
     def new_axis(self):
         axis = self.axes_counter
         self.axes_counter += 1
         return axis
 
+    def find_axis(self, axis): # Representative of all axes that got unified with this one
+        root = axis
+        while root in self.axis_parent:
+            root = self.axis_parent[root]
+        while axis != root: # Path compression
+            self.axis_parent[axis], axis = root, self.axis_parent[axis]
+        return root
+
+    def merge_axes(self, axis, other): # Unifies two axes, other becomes the representative unless only axis comes from a variable
+        axis = self.find_axis(axis)
+        other = self.find_axis(other)
+        if axis == other:
+            return
+        if self.is_placeholder_axis(other) and not self.is_placeholder_axis(axis):
+            axis, other = other, axis
+        self.axis_parent[axis] = other
+
+    def is_placeholder_axis(self, axis): # Axes that do not come from a variable should get overriden by ones that do
+        origin = self.axis_to_origin[self.find_axis(axis)]
+        return origin.startswith('broadcast_axis') or origin.startswith('delta')
+
     def new_constant(self):
         constant = self.constant_counter
         self.constant_counter += 1
@@ -40,13 +74,29 @@ class TreeCompanion(): # Since trees are recursive datastructures, we use this c
         self.delta_counter += 1
         return delta
 
+    def new_node(self, nodetype, name, left=None, right=None): # Nodes are built through here, so that equal subtrees are the same object
+        structure = (nodetype, name, -1, (), left, right)
+        node = self.node_table.get(structure)
+        if node is None or node.structure() != structure: # Nodes that got rewritten in place leave stale entries behind
+            node = Tree(nodetype, name, left, right, companion=self)
+            self.node_table[structure] = node
+        return node
+
+    def variable_bit(self, name):
+        if name not in self.variable_bits:
+            self.variable_bits[name] = 1 << len(self.variable_bits)
+        return self.variable_bits[name]
+
 class Tree():
+    # Expression DAGs can have a lot of nodes, so they get fixed slots instead of a __dict__
+    __slots__ = ('type', 'name', 'left', 'right', 'incoming', 'rank', 'axes', 'leftIndices', 'rightIndices', 'resultIndices', 'companion', 'id', 'hash', 'variables', 'stale')
+
     def __init__(self, nodetype, name, left=None, right=None, companion=None):
         self.type = nodetype
         self.name = name
         self.left = left
         self.right = right
-        self.incoming = []  # Nodes from incoming edges, only filled after common subexpression elimination
+        self.incoming = {}  # Nodes from incoming edges (as keys of an insertion ordered dict), see add_incoming_edges
         self.rank = -1      # Initialization value
         self.axes = []
         if self.type == NODETYPE.PRODUCT:    
@@ -61,12 +111,49 @@ class Tree():
         
         self.id = self.companion.node_counter   # This is just for the visualization
         self.companion.node_counter += 1
+        self.hash = hash((nodetype, name, left, right))  # Structural hash, computed once from the cached hashes of the children
+        self.variables = 0  # Bitset of the variables this subtree depends on
+        self.update_variables()
+        self.stale = STALE  # New nodes still need their rank and axes
+        if left: left.incoming[self] = None
+        if right: right.incoming[self] = None
     
-    def set_left(self, left):
+    def set_left(self, left): # Rewrites of the DAG should go through these, so that the variable bitsets, stale flags and incoming edges stay up to date
+        if self.left and self.left != self.right:
+            self.left.incoming.pop(self, None)
         self.left = left
+        if left: left.incoming[self] = None
+        self.update_variables()
+        self.mark_modified()
     
     def set_right(self, right):
+        if self.right and self.right != self.left:
+            self.right.incoming.pop(self, None)
         self.right = right
+        if right: right.incoming[self] = None
+        self.update_variables()
+        self.mark_modified()
+
+    def mark_modified(self): # Rank and axes of this node and all of its ancestors have to be inferred again
+        to_mark = [self]
+        while to_mark:
+            node = to_mark.pop()
+            if node.stale == STALE: # Its ancestors got marked along with it
+                continue
+            node.stale = STALE
+            to_mark.extend(node.incoming)
+
+    def update_variables(self): # Recomputes the variable bitset of this node and passes changes on to the parents
+        to_update = [self]
+        while to_update:
+            node = to_update.pop()
+            if node.type == NODETYPE.VARIABLE:
+                variables = node.companion.variable_bit(node.name)
+            else:
+                variables = (node.left.variables if node.left else 0) | (node.right.variables if node.right else 0)
+            if variables != node.variables:
+                node.variables = variables
+                to_update.extend(node.incoming)
     
     def set_name(self, name):
         self.name = name
@@ -77,90 +164,153 @@ class Tree():
         self.resultIndices = result
 
     def __repr__(self):
-        to_print = self.name
-        if self.type in [NODETYPE.CONSTANT, NODETYPE.DELTA]:
-            to_print = to_print.split('_')[0] # Removes the running id 
-        if self.type == NODETYPE.DELTA:
-            to_print += f'({str(int(self.rank / 2))})'
-        if self.right:
-            if self.left:
-                return f'({self.left} {to_print} {self.right})'
-            else:
-                if self.name == 'elementwise_inverse':
-                    const = f'1_{self.companion.new_constant()}'
-                    self.companion.printing_constants[const] = self.right.axes
-                    return f'({1} / ({self.right}))'
-                return f'({to_print}({self.right}))'
-        else:
-            return f'{to_print}'
+        return self.to_string(False)
     
     def repr_with_constant_numbers(self):
+        return self.to_string(True)
+
+    def to_string(self, with_constant_numbers): # Prints every node once and reuses the result wherever the node is shared
+        printed = {}
+        for node in self.postorder():
+            printed[node] = node.node_to_string(printed, with_constant_numbers)
+        return printed[self]
+
+    def node_to_string(self, printed, with_constant_numbers): # Requires the strings of the children in printed
         to_print = self.name
+        if self.type in [NODETYPE.CONSTANT, NODETYPE.DELTA] and not with_constant_numbers:
+            to_print = to_print.split('_')[0] # Removes the running id 
         if self.type == NODETYPE.DELTA:
             to_print += f'({str(int(self.rank / 2))})'
         if self.right:
             if self.left:
-                return f'({self.left} {to_print} {self.right})'
+                return f'({printed[self.left]} {to_print} {printed[self.right]})'
             else:
                 if self.name == 'elementwise_inverse':
                     const = f'1_{self.companion.new_constant()}'
                     self.companion.printing_constants[const] = self.right.axes
-                    return f'({const} / ({self.right}))'
-                return f'({to_print}({self.right}))'
+                    if with_constant_numbers:
+                        return f'({const} / ({printed[self.right]}))'
+                    return f'({1} / ({printed[self.right]}))'
+                return f'({to_print}({printed[self.right]}))'
         else:
             return f'{to_print}'
     
-    def __eq__(self, other):
-        return other and self.type == other.type and self.name == other.name and self.rank == other.rank and self.left == other.left and self.right == other.right and self.axes == other.axes
-    
+    # Equal subtrees are the same object (see TreeCompanion.new_node and eliminate_common_subtrees),
+    # so nodes keep the default identity comparison
     def __hash__(self): # Necessary for instances to behave sanely in dicts and sets.
-        return hash((self.type, self.name, self.rank, self.left, self.right))
+        return self.hash
+
+    # Pickling leaves out the incoming edges, since unpickling would hash nodes before their state is restored.
+    # They get rebuilt by add_incoming_edges like after any other change of the DAG
+    def __getstate__(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__ if slot != 'incoming' and hasattr(self, slot)}
+
+    def __setstate__(self, state):
+        self.incoming = {}
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+    def structure(self): # Everything that makes two nodes equal, the children are compared by identity
+        return (self.type, self.name, self.rank, tuple(self.companion.find_axis(axis) for axis in self.axes), self.left, self.right)
+
+    # Traversals of the DAG, each of them visits every node exactly once, no matter how many paths lead to it
+    def postorder(self): # Children before their parents
+        visited = set()
+        stack = [(self, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if children_done:
+                yield node
+            elif node not in visited:
+                visited.add(node)
+                stack.append((node, True))
+                if node.right: stack.append((node.right, False))
+                if node.left: stack.append((node.left, False))
+
+    def preorder(self): # Depth first, every node when it is reached for the first time
+        visited = set()
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node in visited:
+                continue
+            visited.add(node)
+            yield node
+            if node.right: stack.append(node.right)
+            if node.left: stack.append(node.left)
+
+    def reverse_topological(self): # Every node after all of its parents
+        return reversed(list(self.postorder()))
+
+    def stale_postorder(self, flag): # Like postorder, but only goes through nodes that have the given stale flag set
+        visited = set()
+        stack = [(self, False)] if self.stale & flag else []
+        while stack:
+            node, children_done = stack.pop()
+            if children_done:
+                yield node
+            elif node not in visited:
+                visited.add(node)
+                stack.append((node, True))
+                if node.right and node.right.stale & flag: stack.append((node.right, False))
+                if node.left and node.left.stale & flag: stack.append((node.left, False))
+
+    def copy(self): # New nodes in the same companion, with the same ranks and axes. Shared subtrees stay shared, rewrites of the copy leave this DAG as it is
+        copies = {}     # Node -> its copy
+        for node in self.postorder():
+            copy = Tree(node.type, node.name, copies.get(node.left), copies.get(node.right), companion=node.companion)
+            copy.rank, copy.axes, copy.stale = node.rank, list(node.axes), node.stale
+            if node.type == NODETYPE.PRODUCT:
+                copy.set_indices(node.leftIndices, node.rightIndices, node.resultIndices)
+            copies[node] = copy
+        return copies[self]
 
     def get_all_subtrees(self):
-        if not self.left:
-            leftSubtrees = [None]
-        else:
-            leftSubtrees = self.left.get_all_subtrees()
-        if not self.right:
-            rightSubtrees = [None]
-        else:
-            rightSubtrees = self.right.get_all_subtrees()
-        return [self] + leftSubtrees + rightSubtrees
+        return list(self.preorder())
     
     def dot(self, filename, print_axes=True):
         g = Digraph(format='png', edge_attr={'dir': 'back'}, graph_attr={'dpi': '300'})
-        done_nodes = []
         nodes = self.get_all_subtrees()
         for node in nodes:
-            if node:
-                if print_axes:
-                    g.node(str(node.id), f'{node.name} \n {node.axes}')
-                else:
-                    g.node(str(node.id), str(node.name))
+            if print_axes:
+                g.node(str(node.id), f'{node.name} \n {[self.companion.find_axis(axis) for axis in node.axes]}')
+            else:
+                g.node(str(node.id), str(node.name))
         for node in nodes:
-            if node not in done_nodes:
-                if node and node.left:
-                    g.edge(str(node.id), str(node.left.id), '<')
-                if node and node.right:
-                    g.edge(str(node.id), str(node.right.id), '>')
-                done_nodes.append(node)
+            if node.left:
+                g.edge(str(node.id), str(node.left.id), '<')
+            if node.right:
+                g.edge(str(node.id), str(node.right.id), '>')
         g.render(filename)
 
     def contains(self, node):
-        if self == node:
-            return True
-        else:
-            return (self.left and self.left.contains(node)) or (self.right and self.right.contains(node))
+        if not node:
+            return False
+        if node.type == NODETYPE.VARIABLE: # Variables can be looked up in the bitset
+            return bool(self.variables & node.variables)
+        return any(subtree == node for subtree in self.postorder())
     
+    def contains_any(self, variables): # Whether this (sub)tree contains at least one of the given variable nodes
+        bits = 0
+        for variable in variables:
+            if variable: # Arguments that are not in the expression are None
+                bits |= variable.variables
+        return bool(self.variables & bits)
+
     def find(self, nodename):
-        if self.name == nodename:
-            return self
-        elif self.left and self.left.find(nodename):
-            return self.left.find(nodename)
-        elif self.right and self.right.find(nodename):
-            return self.right.find(nodename)
-        else:
-            return None
+        bit = self.companion.variable_bits.get(nodename)
+        visited = set()
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node in visited or (bit and not node.variables & bit): # Skip subtrees without that variable
+                continue
+            visited.add(node)
+            if node.name == nodename:
+                return node
+            if node.right: stack.append(node.right)
+            if node.left: stack.append(node.left)
+        return None
 
     def check_multiplication(self):
         if self.left.rank != len(self.leftIndices):
@@ -183,11 +333,25 @@ class Tree():
             if not (index in self.leftIndices or index in self.rightIndices):
                 raise Exception(f'Result index \'{index}\' of product node \'{self.name}\' not in left or right index set.')
 
-    def set_tensorrank(self, variable_ranks, arg):
+    # The passes below work on an explicit stack by default, so that the depth of an expression is only bounded by memory.
+    # With recursive=True they instead recurse along every path, which is kept for comparison in benchmarks.
+    # set_tensorrank and unify_axes only look at nodes that are new or got modified since they last ran, and at their ancestors
+    def set_tensorrank(self, variable_ranks, arg, recursive=False):
+        if recursive:
+            self.set_tensorrank_recursive(variable_ranks, arg)
+        else:
+            for node in self.stale_postorder(RANK_STALE):
+                node.set_node_tensorrank(variable_ranks, arg)
+                node.stale &= ~RANK_STALE
+
+    def set_tensorrank_recursive(self, variable_ranks, arg):
         if self.left:
-            self.left.set_tensorrank(variable_ranks, arg)
+            self.left.set_tensorrank_recursive(variable_ranks, arg)
         if self.right:
-            self.right.set_tensorrank(variable_ranks, arg)
+            self.right.set_tensorrank_recursive(variable_ranks, arg)
+        self.set_node_tensorrank(variable_ranks, arg)
+
+    def set_node_tensorrank(self, variable_ranks, arg): # Requires the ranks of the children
         if self.type == NODETYPE.CONSTANT:   # If we reach a constant, it keeps rank -1 and will get broadcasted later (unless it already has a rank)
             pass
         elif self.type == NODETYPE.VARIABLE:
@@ -239,7 +403,7 @@ class Tree():
             self.rank = self.left.rank
             self.axes = self.left.axes
             for i in range(len(self.axes)):
-                if self.companion.axis_to_origin[self.axes[i]].startswith('broadcast_axis') or self.companion.axis_to_origin[self.axes[i]].startswith('delta'): # This axis does not come from a variable, needs to be overriden
+                if self.companion.is_placeholder_axis(self.axes[i]): # This axis does not come from a variable, needs to be overriden
                     self.axes[i] = self.right.axes[i]
         elif self.type == NODETYPE.POWER:
             if self.right.rank != 0:
@@ -262,7 +426,7 @@ class Tree():
                     if i in self.leftIndices and i in self.rightIndices: # If we may take it from both left and right, choose the one with the axis coming from a variable
                         left_axis = self.left.axes[self.leftIndices.index(i)]
                         right_axis = self.right.axes[self.rightIndices.index(i)]
-                        if self.companion.axis_to_origin[left_axis].startswith('broadcast_axis') or self.companion.axis_to_origin[left_axis].startswith('delta'):
+                        if self.companion.is_placeholder_axis(left_axis):
                             self.axes.append(right_axis)
                         else:
                             self.axes.append(left_axis)
@@ -273,61 +437,82 @@ class Tree():
         else:
             raise Exception(f'Unknown node type at node \'{self.name}\'.')
 
-    def unify_axes(self):
+    # Unifies the axes in the companion first and then compacts them in one go. Only the nodes that got unified and their children are compacted,
+    # nodes further down can still refer to axes that got merged into others, so axes get compared through find_axis
+    def unify_axes(self, recursive=False):
+        if recursive:
+            self.unify_axes_recursive()
+            self.compact_axes()
+        else:
+            unified = list(reversed(list(self.stale_postorder(AXES_STALE))))
+            for node in unified:
+                node.unify_node_axes()
+                node.stale &= ~AXES_STALE
+            for node in unified:
+                for n in [node, node.left, node.right]:
+                    if n: n.axes = [self.companion.find_axis(axis) for axis in n.axes]
+
+    def unify_axes_recursive(self):
+        self.unify_node_axes()
+        if self.left:
+            self.left.unify_axes_recursive()
+        if self.right:
+            self.right.unify_axes_recursive()
+
+    def unify_node_axes(self): # Passes the axes of this node on to its children, unifying them with the axes the children had
         if self.type == NODETYPE.CONSTANT or self.type == NODETYPE.DELTA:
             pass
         if self.type == NODETYPE.VARIABLE:
             pass
         if self.type == NODETYPE.ELEMENTWISE_FUNCTION:
-            self.right.axes = self.axes
+            self.pass_axes(self.right, self.axes)
         if self.type == NODETYPE.SPECIAL_FUNCTION:
             if self.name == 'inv' or self.name == 'adj' or self.name =='det':
                 old_axis = self.right.axes[1]
                 self.right.axes[1] = self.right.axes[0]
-                self.get_root().rename_axis(old_axis, self.right.axes[0])
+                self.companion.merge_axes(old_axis, self.right.axes[0])
             if self.name == 'inv' or self.name == 'adj':
-                self.right.axes = self.axes
+                self.pass_axes(self.right, self.axes)
         if self.type == NODETYPE.SUM or self.type == NODETYPE.DIFFERENCE:
-            self.left.axes = self.axes
-            self.right.axes = self.axes
+            self.pass_axes(self.left, self.axes)
+            self.pass_axes(self.right, self.axes)
         if self.type == NODETYPE.POWER:
-            self.left.axes = self.axes
+            self.pass_axes(self.left, self.axes)
         if self.type == NODETYPE.PRODUCT:
             for i in range(len(self.resultIndices)): # Sets left and right child axes to the axes in this node, using indices as guidance
                 for j in range(len(self.leftIndices)):
                     if self.resultIndices[i] == self.leftIndices[j]:
+                        self.companion.merge_axes(self.left.axes[j], self.axes[i])
                         self.left.axes[j] = self.axes[i]
                 for j in range(len(self.rightIndices)):
                     if self.resultIndices[i] == self.rightIndices[j]:
+                        self.companion.merge_axes(self.right.axes[j], self.axes[i])
                         self.right.axes[j] = self.axes[i]
             for i in range(len(self.leftIndices)): # Unifies left and right child axes that are the same, using indices as guidance
                 indexInRight = self.rightIndices.find(self.leftIndices[i])
                 if indexInRight != -1:
                     left_axis = self.left.axes[i]
                     right_axis = self.right.axes[indexInRight]
-                    if self.companion.axis_to_origin[left_axis].startswith('broadcast_axis') or self.companion.axis_to_origin[left_axis].startswith('delta'): # Axis that does not come from a variable, we should choose the other one
-                        self.get_root().rename_axis(left_axis, right_axis)
-                    else:
-                        self.get_root().rename_axis(right_axis, left_axis)
-        if self.left:
-            self.left.unify_axes()
-        if self.right:
-            self.right.unify_axes()
+                    self.companion.merge_axes(right_axis, left_axis) # Prefers the left axis, unless only the right one comes from a variable
+
+    def pass_axes(self, child, axes): # The axes the child had get unified with the new ones, so that its own children need not be visited again
+        for old_axis, new_axis in zip(child.axes, axes):
+            self.companion.merge_axes(old_axis, new_axis)
+        child.axes = axes
+
+    def compact_axes(self): # Replaces every axis by its representative
+        for node in self.postorder():
+            node.axes = [self.companion.find_axis(axis) for axis in node.axes]
     
     def rename_axis(self, axis_to_rename, new_name):
-        def helper(node):
+        for node in self.postorder():
             node.axes = [new_name if (axis == axis_to_rename) else axis for axis in node.axes]
-            if node.left:
-                helper(node.left)
-            if node.right:
-                helper(node.right)
-        helper(self)
     
     def get_root(self): # Requires incoming edges which are added during CSE
-        if not self.incoming:
-            return self
-        else:
-            return self.incoming[0].get_root()
+        root = self
+        while root.incoming:
+            root = next(iter(root.incoming))
+        return root
 
 
     def try_broadcasting(self, desired_rank, desired_axes):
@@ -345,44 +530,52 @@ class Tree():
         else:
             return False
 
-    def eliminate_common_subtrees(self):
-        subtrees = self.get_all_subtrees()
-        hashmap = {}
-        def helper(subtree):
-            if not subtree: return
-            if subtree.left in hashmap:
-                subtree.left = hashmap[subtree.left]
-            else:
-                hashmap[subtree.left] = subtree.left
-            if subtree.right in hashmap:
-                subtree.right = hashmap[subtree.right]
-            else:
-                hashmap[subtree.right] = subtree.right
-        for subtree in subtrees:
-            helper(subtree)
+    def eliminate_common_subtrees(self): # Children are merged before their parents, so comparing the structure of the parents suffices
+        canonical = {}  # Structure -> first node found with that structure
+        for node in list(self.postorder()):
+            if node.left and canonical[node.left.structure()] is not node.left:
+                node.set_left(canonical[node.left.structure()])
+            if node.right and canonical[node.right.structure()] is not node.right:
+                node.set_right(canonical[node.right.structure()])
+            canonical.setdefault(node.structure(), node)
     
-    def add_incoming_edges(self):
-        if self.left:
-            self.left.incoming.append(self)
-            self.left.add_incoming_edges()
-        if self.right:
-            self.right.incoming.append(self)
-            self.right.add_incoming_edges()
+    def add_incoming_edges(self): # New nodes and set_left/set_right keep the edges up to date, this is only needed after rewrites that assign children directly
+        for node in self.preorder():
+            if node.left:
+                node.left.incoming[node] = None
+            if node.right:
+                node.right.incoming[node] = None
         
     def remove_nonexistant_axes(self):  # Removes from self.companion.axis_to_origin all axes that do not occur in this (sub)tree
-        def contains_axis(node, axis):
-            if not node:
-                return False
-            else:
-                return (axis in node.axes) or contains_axis(node.left, axis) or contains_axis(node.right, axis)
+        occurring_axes = set()
+        for node in self.postorder():
+            occurring_axes.update(self.companion.find_axis(axis) for axis in node.axes)
         axes_to_remove = []
         for axis in self.companion.axis_to_origin.keys():
-            if not contains_axis(self, axis):
+            if not axis in occurring_axes:
                 axes_to_remove.append(axis)
         for axis in axes_to_remove:
             self.companion.axis_to_origin.pop(axis)
         
-    def remove_unneccessary_deltas(self):
+    def remove_unneccessary_deltas(self, recursive=False):
+        if recursive:
+            return self.remove_unneccessary_deltas_recursive()
+        new_self = self
+        for node in self.preorder(): # The children of a node are only looked at after the node is done
+            replacement = node.remove_node_delta()
+            if node == self:
+                new_self = replacement
+        return new_self
+
+    def remove_unneccessary_deltas_recursive(self):
+        new_self = self.remove_node_delta()
+        if self.left:
+            self.left.remove_unneccessary_deltas_recursive()
+        if self.right:
+            self.right.remove_unneccessary_deltas_recursive()
+        return new_self
+
+    def remove_node_delta(self): # Replaces this node by its other operand in all parents if it is a product with a delta that does nothing
         def left_indices_fit():
             is_delta_zero = self.leftIndices == '' and self.rightIndices == self.resultIndices
             fits_one_way = self.rightIndices == self.leftIndices[:(len(self.leftIndices)//2)] and self.resultIndices == self.leftIndices[(len(self.leftIndices)//2):]
@@ -397,36 +590,58 @@ class Tree():
         if self.type == NODETYPE.PRODUCT:
             if self.left.name.startswith('delta') and left_indices_fit():
                 new_self = self.right
-                self.add_incoming_edges()
-                for parent in self.incoming:
+                for parent in list(self.incoming):
                     if parent.left == self:
-                        parent.left = new_self
+                        parent.set_left(new_self)
                     if parent.right == self:
-                        parent.right = new_self
+                        parent.set_right(new_self)
             if self.right.name.startswith('delta') and right_indices_fit():
                 new_self = self.left
-                self.add_incoming_edges()
-                for parent in self.incoming:
+                for parent in list(self.incoming):
                     if parent.left == self:
-                        parent.left = new_self
+                        parent.set_left(new_self)
                     if parent.right == self:
-                        parent.right = new_self
+                        parent.set_right(new_self)
+        return new_self
+
+    def fix_missing_indices(self, args, recursive=False):
+        if recursive:
+            return self.fix_missing_indices_recursive(args)
+        new_self = self.fix_node_missing_indices(args)
+        replacements = {self: new_self}  # Node -> what its parents should point to instead
+        stack = [(self, 'right'), (self, 'left')]  # Operands still to be handled, left before right
+        while stack:
+            node, side = stack.pop()
+            child = node.left if side == 'left' else node.right
+            if not child:
+                continue
+            if child not in replacements: # Shared nodes are only fixed once
+                replacements[child] = child.fix_node_missing_indices(args)
+                stack.extend([(child, 'right'), (child, 'left')])
+            if side == 'left':
+                node.set_left(replacements[child])
+            else:
+                node.set_right(replacements[child])
+        return new_self
+
+    def fix_missing_indices_recursive(self, args):
+        new_self = self.fix_node_missing_indices(args)
         if self.left:
-            self.left.remove_unneccessary_deltas()
+            self.set_left(self.left.fix_missing_indices_recursive(args))
         if self.right:
-            self.right.remove_unneccessary_deltas()
+            self.set_right(self.right.fix_missing_indices_recursive(args))
         return new_self
 
-    def fix_missing_indices(self, arg):
+    def fix_node_missing_indices(self, args): # Returns the node that should replace this one
         def add_blowup(resultIndices, missingIndices):
-            blowup = Tree(NODETYPE.PRODUCT, f'*({resultIndices+missingIndices},{missingIndices}->{resultIndices})', self, Tree(NODETYPE.CONSTANT, f'1_{self.companion.new_constant()}', companion=self.companion), companion=self.companion)
+            parents = list(self.incoming)   # Before the blowup becomes one of them
+            blowup = self.companion.new_node(NODETYPE.PRODUCT, f'*({resultIndices+missingIndices},{missingIndices}->{resultIndices})', self, self.companion.new_node(NODETYPE.CONSTANT, f'1_{self.companion.new_constant()}'))
             blowup.set_indices(resultIndices+missingIndices, missingIndices, resultIndices)
-            self.add_incoming_edges()
-            for parent in self.incoming:
+            for parent in parents:
                 if parent.left == self:
-                    parent.left = blowup
+                    parent.set_left(blowup)
                 if parent.right == self:
-                    parent.right = blowup
+                    parent.set_right(blowup)
             return blowup
         new_self = self
         if self.type == NODETYPE.PRODUCT:
@@ -434,36 +649,22 @@ class Tree():
             s2 = self.rightIndices
             s3 = self.resultIndices
             missingIndices = ''
-            if self.left and self.left.contains(arg):
+            if self.left and self.left.contains_any(args):
                 missingIndices = ''.join([index for index in s1 if not (index in s2 or index in s3)])
-            elif self.right and self.right.contains(arg):
-                missingIndices = ''.join([index for index in s2 if not (index in s1 or index in s3)])
+            if self.right and self.right.contains_any(args):   # Both operands can contain an argument
+                missingIndices += ''.join([index for index in s2 if not (index in s1 or index in s3)])
 
             if missingIndices: # Special problem case
                 oldResultIndices = self.resultIndices
                 self.resultIndices += missingIndices
                 self.name = f'*({s1},{s2}->{self.resultIndices})'
+                self.mark_modified()
                 new_self = add_blowup(oldResultIndices, missingIndices)
-        if self.left:
-            self.left = self.left.fix_missing_indices(arg)
-        if self.right:
-            self.right = self.right.fix_missing_indices(arg)
         return new_self
     
     def rename_equivalent_constants(self):
-        constants = []
-        def helper(node):
+        constants = {}  # (Number, axes) -> first constant found with them
+        for node in self.preorder():
             if node.type == NODETYPE.CONSTANT:
-                equivalent_constant_in_list = None
-                for constant in constants:
-                    if constant.name.split('_')[0] == node.name.split('_')[0] and constant.axes == node.axes: # Same number and same axes
-                        equivalent_constant_in_list = constant
-                if node not in constants and not equivalent_constant_in_list:
-                    constants.append(node)
-                elif node not in constants and equivalent_constant_in_list:
-                    node.name = constant.name
-            if node.left:
-                helper(node.left)
-            if node.right:
-                helper(node.right)
-        helper(self)
\ No newline at end of file
+                constant = constants.setdefault((node.name.split('_')[0], tuple(self.companion.find_axis(axis) for axis in node.axes)), node)
+                node.name = constant.name
\ No newline at end of file
@@ -0,0 +1,120 @@
+import unittest
+from parser import parse
+from tree import TreeCompanion, NODETYPE, RANK_STALE, STALE
+
+class TreeTests(unittest.TestCase):
+    def shared_chain(self, length):
+        companion = TreeCompanion()
+        dag = companion.new_node(NODETYPE.VARIABLE, 'a')
+        for i in range(length):
+            dag = companion.new_node(NODETYPE.SUM, '+', dag, dag)
+        return dag
+
+    def test_postorder(self):
+        test = 'declare a 1 b 1 expression sin(a) *(i,i->) (a + b) derivative wrt a'
+        dag, _, _ = parse(test)
+        names = [node.name for node in dag.postorder()]
+        self.assertEqual(names, ['a', 'sin', 'b', '+', '*(i,i->)'])
+    def test_preorder(self):
+        test = 'declare a 1 b 1 expression sin(a) *(i,i->) (a + b) derivative wrt a'
+        dag, _, _ = parse(test)
+        names = [node.name for node in dag.preorder()]
+        self.assertEqual(names, ['*(i,i->)', 'sin', 'a', '+', 'b'])
+    def test_reverse_topological(self):
+        test = 'declare a 1 b 1 expression sin(a) *(i,i->) (a + b) derivative wrt a'
+        dag, _, _ = parse(test)
+        seen = set()
+        for node in dag.reverse_topological():
+            self.assertFalse(node.left in seen or node.right in seen)
+            seen.add(node)
+        self.assertEqual(len(seen), 5)
+    def test_shared_chain(self):
+        dag = self.shared_chain(100)
+        self.assertEqual(len(dag.get_all_subtrees()), 101)
+        self.assertEqual(len(list(dag.reverse_topological())), 101)
+        dag.set_tensorrank({'a': 1}, None)
+        dag.add_incoming_edges()
+        dag.unify_axes()
+        dag.remove_nonexistant_axes()
+        self.assertEqual(dag.rank, 1)
+        self.assertEqual(list(dag.companion.axis_to_origin.values()), ['a[0]'])
+    def test_shared_repr(self):
+        dag = self.shared_chain(3)
+        self.assertEqual(str(dag), '(((a + a) + (a + a)) + ((a + a) + (a + a)))')
+
+    def test_merge_axes(self):
+        companion = TreeCompanion()
+        axes = [companion.new_axis() for i in range(4)]
+        companion.axis_to_origin.update({axes[0]: 'A[0]', axes[1]: 'broadcast_axis_product', axes[2]: 'delta_0[0]', axes[3]: 'B[1]'})
+        companion.merge_axes(axes[0], axes[1]) # The axis from a variable stays the representative
+        companion.merge_axes(axes[2], axes[1])
+        self.assertEqual([companion.find_axis(axis) for axis in axes[0:3]], [axes[0]] * 3)
+        companion.merge_axes(axes[0], axes[3])
+        self.assertEqual({companion.find_axis(axis) for axis in axes}, {axes[3]})
+    def test_unify_axes(self):
+        test = 'declare A 2 B 2 expression (A + 1) *(ij,jk->ik) inv(B) derivative wrt A'
+        dag, _, variable_ranks = parse(test)
+        dag.set_tensorrank(variable_ranks, None)
+        dag.add_incoming_edges()
+        dag.unify_axes()
+        A = dag.find('A')
+        B = dag.find('B')
+        self.assertEqual(A.axes[1], B.axes[0])
+        self.assertEqual(B.axes[0], B.axes[1])
+        self.assertEqual(dag.left.right.axes, A.axes) # The broadcasted constant got the axes of A
+        self.assertEqual(dag.axes, [A.axes[0], B.axes[0]])
+
+    def test_incremental_inference(self):
+        test = 'declare a 1 b 1 expression sin(a) *(i,i->) (cos(a) + b) derivative wrt a'
+        dag, _, variable_ranks = parse(test)
+        dag.set_tensorrank(variable_ranks, None)
+        self.assertEqual([node.name for node in dag.postorder() if node.stale & RANK_STALE], [])
+        dag.add_incoming_edges()
+        dag.unify_axes()
+        self.assertEqual([node.name for node in dag.postorder() if node.stale], [])
+        plus = dag.right
+        plus.set_left(dag.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, 'tanh', None, plus.left.right)) # (tanh(a) + b)
+        self.assertEqual([node.name for node in dag.postorder() if node.stale == STALE], ['tanh', '+', '*(i,i->)'])
+        dag.set_tensorrank(variable_ranks, None)
+        dag.unify_axes()
+        self.assertEqual([node.name for node in dag.postorder() if node.stale], [])
+        self.assertEqual(plus.left.rank, 1)
+        self.assertEqual(plus.left.axes, dag.find('a').axes)
+    def test_incremental_compaction(self): # Only the nodes that get unified again and their children get compacted
+        test = 'declare a 1 b 1 expression sin(cos(a)) *(i,i->) b derivative wrt a'
+        dag, _, variable_ranks = parse(test)
+        dag.set_tensorrank(variable_ranks, None)
+        dag.unify_axes()
+        cos = dag.left.right
+        axes = cos.axes
+        dag.set_right(dag.companion.new_node(NODETYPE.ELEMENTWISE_FUNCTION, 'tanh', None, dag.right))
+        dag.set_tensorrank(variable_ranks, None)
+        dag.unify_axes()
+        self.assertIs(cos.axes, axes)
+        self.assertEqual(dag.right.axes, dag.left.axes)
+
+    def test_incoming_edges(self): # New nodes and rewired children keep the incoming edges up to date without add_incoming_edges
+        companion = TreeCompanion()
+        a = companion.new_node(NODETYPE.VARIABLE, 'a')
+        b = companion.new_node(NODETYPE.VARIABLE, 'b')
+        plus = companion.new_node(NODETYPE.SUM, '+', a, b)
+        self.assertEqual(list(a.incoming), [plus])
+        plus.set_right(a)
+        self.assertEqual(list(a.incoming), [plus])
+        self.assertEqual(list(b.incoming), [])
+        plus.set_left(b)    # a is still the right operand
+        self.assertEqual(list(a.incoming), [plus])
+        self.assertEqual(list(b.incoming), [plus])
+
+    def test_rename_equivalent_constants(self):
+        test = 'declare a 1 expression (a + 2) *(i,i->) (a + 2) + 2 *(,->) 2 derivative wrt a'
+        dag, _, variable_ranks = parse(test)
+        dag.set_tensorrank(variable_ranks, None)
+        dag.unify_axes()
+        dag.rename_equivalent_constants()
+        twos = [node for node in dag.postorder() if node.type == NODETYPE.CONSTANT and node.name.startswith('2')]
+        self.assertEqual(len({node.name for node in twos if node.axes}), 1) # Same number and same axes
+        self.assertEqual(len({node.name for node in twos}), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import shared_memory
+from time import perf_counter
+
+from differentiator import differentiate
+from exporttree import python_function
+from numcheck import numcheck, get_deltas_in_input, _approximate_entries
+
+# This module runs numerical checks of derivatives on a process pool, either many inputs at once or the perturbations of one large argument.
+# Every check gives a report, a dict with the result, the error message if there was one and the timings of its steps
+
+def verify(inputs, max_workers=None, h=1e-8, err_limit=1e-6, mode='full'): # One report per input, in the order of the inputs
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(partial(verify_input, h=h, err_limit=err_limit, mode=mode), inputs))
+
+def verify_input(input, h=1e-8, err_limit=1e-6, mode='full'):
+    report = {'input': input, 'passed': False, 'error': None, 'differentiate_seconds': None, 'check_seconds': None}
+    try:
+        start = perf_counter()
+        diffDag, originalDag, arg_name, variable_ranks = differentiate(input)
+        report['differentiate_seconds'] = perf_counter() - start
+        start = perf_counter()
+        report['passed'] = bool(numcheck(originalDag, diffDag, variable_ranks, arg_name, h=h, err_limit=err_limit, mode=mode))
+        report['check_seconds'] = perf_counter() - start
+    except Exception as e:  # A failing input shouldn't stop the others
+        report['error'] = f'{type(e).__name__}: {e}'
+    return report
+
+def summary(reports):
+    return {'inputs': len(reports),
+            'passed': sum(report['passed'] for report in reports),
+            'failed': sum(not report['passed'] and report['error'] == None for report in reports),
+            'errors': sum(report['error'] != None for report in reports),
+            'seconds': sum((report['differentiate_seconds'] or 0) + (report['check_seconds'] or 0) for report in reports)}
+
+
+# Checks the derivative of one input for the given values of its variables (and of the deltas in the expression), with the perturbations of
+# the argument split into chunks across the processes. The values and the approximated derivative live in shared memory, so no process copies them
+def verify_argument(input, values, max_workers=None, chunks=None, h=1e-8, err_limit=1e-6, memory_limit=2**26):
+    report = {'input': input, 'passed': False, 'error': None, 'differentiate_seconds': None, 'check_seconds': None, 'chunk_seconds': [], 'max_error': None}
+    blocks = []
+    try:
+        start = perf_counter()
+        diffDag, originalDag, arg_name, variable_ranks = differentiate(input)
+        report['differentiate_seconds'] = perf_counter() - start
+        start = perf_counter()
+        names = list(variable_ranks.keys()) + get_deltas_in_input(originalDag)[0]
+        missing = [name for name in names if not name in values]
+        if missing:
+            raise Exception(f'No values for {", ".join(missing)}')
+        shared = {}     # Variable name -> (name of the shared memory block, shape)
+        for name in names:
+            value = np.asarray(values[name], dtype=float)
+            array, block = _shared_array(value.shape)
+            array[...] = value
+            blocks.append(block)
+            shared[name] = (block.name, value.shape)
+        f = python_function(originalDag, names)
+        f_shape = np.shape(f(*[values[name] for name in names]))
+        entries = int(np.prod(np.shape(values[arg_name])))
+        df_approx, block = _shared_array((int(np.prod(f_shape)), entries))
+        blocks.append(block)
+        chunks = chunks or 4 * (max_workers or 1)
+        bounds = [(entries * i // chunks, entries * (i + 1) // chunks) for i in range(chunks)]
+        chunk = partial(_approximate_chunk, originalDag, names, arg_name, shared, (block.name, df_approx.shape), h, memory_limit)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            report['chunk_seconds'] = list(executor.map(chunk, *zip(*bounds)))
+        df_computed = python_function(diffDag, names)(*[values[name] for name in names])
+        abs_error = np.abs(df_approx.reshape(f_shape + np.shape(values[arg_name])) - df_computed)
+        report['max_error'] = float(np.max(abs_error, initial=0))
+        report['passed'] = report['max_error'] < err_limit
+        report['check_seconds'] = perf_counter() - start
+    except Exception as e:  # Same as in verify_input, the report says what went wrong
+        report['error'] = f'{type(e).__name__}: {e}'
+    finally:
+        array = df_approx = None  # Views of the blocks have to go before the blocks get closed
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return report
+
+def _approximate_chunk(originalDag, names, arg_name, shared, output, h, memory_limit, start, stop): # Runs in the worker processes
+    seconds = perf_counter()
+    blocks = {name: shared_memory.SharedMemory(name=block) for name, (block, shape) in shared.items()}
+    output_block = shared_memory.SharedMemory(name=output[0])
+    try:
+        values = {name: np.ndarray(shared[name][1], dtype=float, buffer=blocks[name].buf) for name in names}
+        df_approx = np.ndarray(output[1], dtype=float, buffer=output_block.buf)
+        X = values[arg_name]
+        batched_f = python_function(originalDag, names, batched=[arg_name], varying=[arg_name])(*[X[np.newaxis] if name == arg_name else values[name] for name in names])
+        _approximate_entries(batched_f, X, h, memory_limit, start, stop, df_approx)
+    finally:
+        values = df_approx = X = batched_f = None
+        for block in list(blocks.values()) + [output_block]:
+            block.close()
+    return perf_counter() - seconds
+
+def _shared_array(shape):
+    block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(float).itemsize))
+    return np.ndarray(shape, dtype=float, buffer=block.buf), block
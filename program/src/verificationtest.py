@@ -0,0 +1,47 @@
+import unittest
+import numpy as np
+import os
+from unittest.mock import patch
+from differentiator import differentiate
+from verification import verify, verify_input, verify_argument, summary
+
+class VerificationTests(unittest.TestCase):
+    def test_verify(self):
+        tests = ['declare x 1 A 2 expression A *(ij,j->i) tanh(A *(ij,j->i) x) derivative wrt x',
+                 'declare X 2 expression adj(X) derivative wrt X',
+                 'declare a 0 expression b derivative wrt a']
+        reports = verify(tests, max_workers=2, h=1e-6, err_limit=1e-4)
+        self.assertEqual([report['input'] for report in reports], tests)
+        self.assertEqual([report['passed'] for report in reports], [True, True, False])
+        self.assertTrue(reports[2]['error'].startswith('KeyError'))
+        self.assertGreater(reports[0]['check_seconds'], 0)
+        self.assertEqual({key: value for key, value in summary(reports).items() if key != 'seconds'}, {'inputs': 3, 'passed': 2, 'failed': 0, 'errors': 1})
+        self.assertEqual(verify_input(tests[0], mode='directional', h=1e-6, err_limit=1e-4)['passed'], True)
+
+    def test_verify_argument(self):
+        values = {'X': np.random.random_sample((12,7)), 'A': np.random.random_sample((5,12))}
+        before = set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+        report = verify_argument('declare X 2 A 2 expression sin(A *(ij,jk->ik) X) derivative wrt X', values, max_workers=2, chunks=3, h=1e-6, err_limit=1e-4)
+        self.assertTrue(report['passed'])
+        self.assertLess(report['max_error'], 1e-4)
+        self.assertEqual(len(report['chunk_seconds']), 3)
+        if os.path.isdir('/dev/shm'):
+            self.assertEqual(set(os.listdir('/dev/shm')), before) # All shared memory got released
+        report = verify_argument('declare X 2 A 2 expression sin(A *(ij,jk->ik) X) derivative wrt X', {'X': values['X']})
+        self.assertFalse(report['passed'])
+        self.assertEqual(report['error'], 'Exception: No values for A')
+        report = verify_argument('declare X 2 expression Y derivative wrt X', values)   # Fails during differentiation
+        self.assertFalse(report['passed'])
+        self.assertTrue(report['error'].startswith('KeyError'))
+
+    def test_verify_argument_wrong_derivative(self): # A derivative that is larger than the real one everywhere
+        input = 'declare x 1 expression (sin(x) + tanh(x)) + tanh(x) derivative wrt x'
+        _, originalDag, arg_name, variable_ranks = differentiate(input)
+        wrongDag = differentiate('declare x 1 expression ((sin(x) + tanh(x)) + tanh(x)) + tanh(x) derivative wrt x')[0]
+        with patch('verification.differentiate', return_value=(wrongDag, originalDag, arg_name, variable_ranks)):
+            report = verify_argument(input, {'x': np.random.random_sample(4)}, max_workers=1, h=1e-6, err_limit=1e-4)
+        self.assertFalse(report['passed'])
+        self.assertGreater(report['max_error'], 0.1)
+
+if __name__ == '__main__':
+    unittest.main()